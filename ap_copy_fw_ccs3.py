@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
 
-import csv
-import subprocess
+import asyncio
+import functools
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
+from ssh_mux import MuxClient, add_mux_args, mux_from_args, open_pool, stage_files as scp_stage_files
+from fleet import add_fleet_args, fleet_from_args
+from inventory import add_inventory_args, inventory_files, read_hosts_from_csv, selection_from_args
+from work_queue import add_queue_args
+from fleet_state import COPIED, FILES_VERIFIED, add_state_args, state_from_args
+from artifacts import DIGEST_ALGORITHMS, file_digest
+from sftp_upload import ChecksumMismatch, stage_files, throughput
+from bandwidth import add_bandwidth_args, governor_from_args
+from fanout import add_fanout_args, fanout_from_args
+from artifact_server import (FETCH_POLL, FetchUnavailable, add_http_args, fetch_done, finish_fetch, server_from_args,
+                             start_fetch)
+from results import LOGIN, REACH, TRANSFER, UNREACHABLE, VERIFY, HostFailure, failure
 
-def ping_host(host):
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 5
+DESTINATION = '/tmp'
+
+async def ping_host(host, fleet):
     """Ping the host to check if it is reachable."""
-    try:
-        output = subprocess.check_output(['ping', '-c', '1', host], stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return await fleet.ping(host)
 
 # def scp_file(host, file_path, destination):
 #     """SCP the file to the destination on the host without host key validation."""
@@ -25,59 +37,194 @@ def ping_host(host):
 #         print(f"Error copying file to {host}: {e.output.decode()}")
 #         return False
     
-def scp_files(host, file_path1, file_path2, destination):
-    """SCP two files to the destination on the host without host key validation."""
+def scp_files(host, file_paths, destination, pool, timeouts, algorithm='sha256', governor=None):
+    """Stage the files in the destination on the host over one pooled SSH connection.
+
+    Files already there with the right digest are not sent again; the ones
+    that are sent are checked on the AP afterwards, and a partial file left
+    by an earlier attempt is resumed. Uploads are held to the governor's
+    bandwidth limits.
+    Returns (transfers, verified), verified being True if every file's digest was confirmed.
+    Raises HostFailure if the login, the transfers or the verification fail.
+    """
+    throttle = functools.partial(governor.throttle, host) if governor is not None and governor.enabled else None
     try:
-        subprocess.check_output([
-            'sshpass', '-e', 'scp', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
-            file_path1, f'{host}:{destination}'
-        ], stderr=subprocess.STDOUT)
-        subprocess.check_output([
-            'sshpass', '-e', 'scp', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
-            file_path2, f'{host}:{destination}'
-        ], stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error copying files to {host}: {e.output.decode()}")
-        return False    
-
-def process_host(host, file_path1,file_path2):
-    """Process a single host: ping and SCP file."""
-    if ping_host(host):
-        if scp_files(host, file_path1, file_path2, '/tmp'):
-            return (host, 'good')
-        else:
-            return (host, 'bad')
-    else:
-        return (host, 'bad')
+        client = pool.get(host, timeout=timeouts.login)
+        # Over an OpenSSH master the files go by scp instead of SFTP.
+        sftp = None if isinstance(client, MuxClient) else client.open_sftp()
+    except Exception as e:
+        print(f"Error copying files to {host}: {e}")
+        raise failure(e, LOGIN)
+    try:
+        if sftp is None:
+            return scp_stage_files(client, file_paths, destination, algorithm, timeouts.command)
+        # A stalled link must fail the transfer, not hang it.
+        sftp.get_channel().settimeout(timeouts.command)
+        return stage_files(client, sftp, file_paths, destination, algorithm, timeouts.command, throttle)
+    except ChecksumMismatch as e:
+        print(f"Error copying files to {host}: {e}")
+        raise failure(e, VERIFY)
+    except Exception as e:
+        print(f"Error copying files to {host}: {e}")
+        raise failure(e, TRANSFER)
+    finally:
+        if sftp is not None:
+            sftp.close()
+
+async def upload_files(host, fleet, file_paths, destination, pool, algorithm='sha256', governor=None):
+    """Upload the files to the host with scp_files, retrying a transfer cut short.
+
+    A failed transfer is retried up to UPLOAD_ATTEMPTS times on a fresh
+    connection, resuming from the partial file. The AP's lock and the SSH
+    slots are given up while waiting to retry.
+    Returns True if every file's digest was confirmed.
+    Raises HostFailure if the login, the transfers or the verification fail.
+    """
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            transfers, verified = await fleet.run_on_host(host, scp_files, file_paths, destination, pool,
+                                                          fleet.timeouts(host), algorithm, governor, exclusive=True)
+            break
+        except HostFailure as e:
+            if e.phase != TRANSFER or attempt == UPLOAD_ATTEMPTS:
+                raise
+            print(f"{host}: transfer failed (attempt {attempt} of {UPLOAD_ATTEMPTS}), retrying.")
+            pool.close(host)
+            await asyncio.sleep(UPLOAD_RETRY_DELAY * attempt)
+    for transfer in transfers:
+        name = os.path.basename(transfer.local_path)
+        if not transfer.sent:
+            print(f"{host}: {name} already present.")
+            continue
+        resumed = f", resumed at byte {transfer.size - transfer.sent}" if transfer.sent < transfer.size else ""
+        print(f"{host}: {name} {transfer.sent} bytes in {transfer.seconds:.2f}s "
+              f"({throughput(transfer):.1f} Mbit/s{resumed})")
+    if not verified:
+        print(f"{host}: no {algorithm}sum on the AP, only file sizes were checked.")
+    return verified
 
-def read_hosts_from_csv(csv_file):
-    """Read hosts from the CSV file."""
+def fetch_step(host, step, pool, timeouts, *args):
+    """Run one step of an HTTP fetch (start_fetch, fetch_done, finish_fetch) on the host.
+
+    FetchUnavailable is passed on; other errors raise HostFailure.
+    """
+    try:
+        client = pool.get(host, timeout=timeouts.login)
+    except Exception as e:
+        print(f"Error copying files to {host}: {e}")
+        raise failure(e, LOGIN)
     try:
-        with open(csv_file, mode='r') as file:
-            csv_reader = csv.DictReader(file, delimiter=',')
-            return [row['SNMP_Host'] for row in csv_reader]
-    except FileNotFoundError:
-        print(f"Error: The file {csv_file} was not found.")
-        exit(1)
+        return step(client, *args, timeout=timeouts.command)
+    except FetchUnavailable:
+        raise
+    except ChecksumMismatch as e:
+        print(f"Error copying files to {host}: {e}")
+        raise failure(e, VERIFY)
     except Exception as e:
-        print(f"Error reading CSV file {csv_file}: {e}")
-        exit(1)
+        print(f"Error copying files to {host}: {e}")
+        raise failure(e, TRANSFER)
 
-def main(csv_file, file_path1, file_path2):
-    good_hosts = []
-    bad_hosts = []
+async def fetch_files(host, fleet, file_paths, destination, pool, algorithm, server):
+    """Have the host fetch the files from the controller's HTTP server and verify them.
 
-    hosts = read_hosts_from_csv(csv_file)
+    The fetch runs in the background on the AP: SSH sessions are only held
+    to start it, poll it every FETCH_POLL seconds and verify the files, but
+    the AP stays locked and counts against --max-fetches throughout. Only
+    those SSH sessions are charged to the host, not the time spent waiting.
+    Returns True once the files are in place, or None if the AP cannot fetch
+    or hash files and they must be uploaded over SFTP instead.
+    Raises HostFailure if the login, a fetch or the verification fails.
+    """
+    timeouts = fleet.timeouts(host)
+    async with fleet.limit('fetch'), fleet.host_lock(host, exclusive=True):
+        try:
+            fetch = await fleet.run_on_host(host, fetch_step, start_fetch, pool, timeouts, server, file_paths,
+                                            destination, algorithm, lock=False)
+            while not await fleet.run_on_host(host, fetch_step, fetch_done, pool, timeouts, fetch, lock=False):
+                await asyncio.sleep(FETCH_POLL)
+        except FetchUnavailable as e:
+            print(f"{host}: {e}, uploading over SFTP instead.")
+            return None
+        transfers = await fleet.run_on_host(host, fetch_step, finish_fetch, pool, timeouts, fetch, lock=False)
+    for transfer in transfers:
+        name = os.path.basename(transfer.local_path)
+        if not transfer.sent:
+            print(f"{host}: {name} already present.")
+            continue
+        print(f"{host}: {name} fetched over HTTP, {transfer.size} bytes in {transfer.seconds:.2f}s")
+    return True
 
-    with ThreadPoolExecutor(max_workers=40) as executor:
-        future_to_host = {executor.submit(process_host, host, file_path1, file_path2): host for host in hosts}
-        for future in as_completed(future_to_host):
-            host, status = future.result()
-            if status == 'good':
-                good_hosts.append(host)
-            else:
-                bad_hosts.append(host)
+def artifact_signature(file_paths, algorithm='sha256'):
+    """Identify a set of artifacts by name and digest, so a new firmware is never mistaken for a copied one."""
+    return ','.join(f"{os.path.basename(path)}:{file_digest(path, algorithm)[:16]}" for path in file_paths)
+
+async def process_host(host, fleet, file_paths, pool, state, algorithm, governor, fanout=None, server=None):
+    """Process a single host: ping and copy the files.
+
+    Files already on the AP with the right digest are not sent again; the
+    state store is only written, never trusted, since /tmp does not survive
+    a reboot. With fan-out the files are relayed from the host's parent AP
+    in the tree when it has one, and sent from here only if that fails. With
+    an HTTP server the AP fetches them from it, falling back to SFTP if it
+    cannot.
+    """
+    signature = artifact_signature(file_paths, algorithm)
+    verified = False
+    try:
+        if not await ping_host(host, fleet):
+            raise HostFailure(UNREACHABLE, REACH)
+        try:
+            if fanout is not None:
+                verified = await fanout.relay(host, fleet, pool, file_paths, DESTINATION, algorithm)
+            if not verified and server is not None:
+                verified = await fetch_files(host, fleet, file_paths, DESTINATION, pool, algorithm, server)
+            if not verified:
+                verified = await upload_files(host, fleet, file_paths, DESTINATION, pool, algorithm, governor)
+        except HostFailure:
+            state.record(host, COPIED, False, signature)
+            raise
+        state.record(host, COPIED, True, signature)
+        if verified:
+            state.record(host, FILES_VERIFIED, True, ','.join(os.path.basename(path) for path in file_paths))
+        return (host, 'good')
+    finally:
+        if fanout is None:
+            pool.close(host)
+        else:
+            fanout.finished(host, verified, pool)
+
+def main(csv_files, selection, file_paths, fleet, state, algorithm='sha256', governor=None, fanout=None,
+         server=None, mux=None):
+    password = os.getenv('SSHPASS')
+    if not password:
+        raise ValueError("No SSH password found. Please set the SSHPASS environment variable.")
+
+    for file_path in file_paths:
+        if not os.path.isfile(file_path):
+            print(f"Error: The file {file_path} was not found.")
+            sys.exit(1)
+
+    hosts = read_hosts_from_csv(csv_files, selection)
+    if fanout is not None:
+        if fleet.queue is not None:
+            print("Error: --fanout needs the whole inventory and cannot be combined with --queue.")
+            sys.exit(1)
+        # The tree is laid out over the whole inventory up front.
+        hosts = list(hosts)
+        fanout.plan(hosts)
+
+    if server is not None:
+        # Fetches run in the background on the APs, outside the SSH limit.
+        fleet.limits['fetch'] = server.max_fetches
+        server.start(file_paths, governor)
+        print(f"Serving the files over HTTP on port {server.port}.")
+    try:
+        with open_pool(password, fleet, mux) as pool, state:
+            good_hosts, bad_hosts = fleet.run(hosts, process_host, file_paths, pool, state, algorithm, governor,
+                                              fanout, server)
+    finally:
+        if server is not None:
+            server.close()
 
     print("Good Hosts:")
     for host in good_hosts:
@@ -87,14 +234,34 @@ def main(csv_file, file_path1, file_path2):
     for host in bad_hosts:
         print(host)
 
+    if governor is not None and governor.enabled:
+        print("\nUpload bandwidth:")
+        for line in governor.report():
+            print(line)
+
+    if fanout is not None:
+        print("\nFan-out:")
+        for line in fanout.report():
+            print(line)
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='SCP files to hosts listed in a CSV file.')
-    parser.add_argument('csv_file', help='Path to the CSV file containing host information.')
-    parser.add_argument('file_path1', help='Path to the file to be copied.')
-    parser.add_argument('file_path2', help='Path to the file to be copied.')
+    add_inventory_args(parser)
+    parser.add_argument('file_paths', nargs='+', help='Path(s) to the file(s) to be copied.')
+    parser.add_argument('--digest', choices=DIGEST_ALGORITHMS, default='sha256',
+                        help='Digest used to skip files already on the AP and verify copies (default: sha256).')
+    add_fleet_args(parser, ssh_workers=40)
+    add_state_args(parser)
+    add_queue_args(parser)
+    add_bandwidth_args(parser)
+    add_fanout_args(parser)
+    add_http_args(parser)
+    add_mux_args(parser)
 
     args = parser.parse_args()
-    main(args.csv_file, args.file_path1, args.file_path2)
+    main(inventory_files(args), selection_from_args(args), args.file_paths, fleet_from_args(args),
+         state_from_args(args), args.digest, governor_from_args(args), fanout_from_args(args),
+         server_from_args(args), mux_from_args(args))
 
@@ -2,83 +2,56 @@
 #
 # This tests to see if the files are there.
 
-import csv
-import paramiko
-import subprocess
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import time
-from pexpect import pxssh
 import os
+from ssh_pool import SSHPool
+from fleet import add_fleet_args, fleet_from_args
+from inventory import add_inventory_args, inventory_files, read_hosts_from_csv, selection_from_args
+from results import FILE_MISSING, LOGIN, REACH, UNREACHABLE, VERIFY, HostFailure, failure
 
-def ping_host(host):
+async def ping_host(host, fleet):
     """Ping the host to check if it is reachable."""
-    try:
-        subprocess.check_output(['ping', '-c', '1', host], stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError:
-        return False
-
-def ssh_and_run_commands(host, files):
-    """SSH into the host and run the specified commands."""
-    try:
-        client = pxssh.pxssh()
-        username = 'root'
-        password = os.getenv('SSH_PASSWORD')
-        if not password:
-            raise ValueError("No SSH password found. Please set the SSH_PASSWORD environment variable.")
+    return await fleet.ping(host)
 
-        if not client.login(host, username, password):
-            print(f"SSH login failed for {host}")
-            return
+def ssh_and_run_commands(host, files, pool, timeouts):
+    """SSH into the host and check for the files over the pooled SFTP session.
 
-        sftp = client.sftp()
+    Raises HostFailure if the login fails or any file is missing.
+    """
+    try:
+        sftp = pool.sftp(host, timeout=timeouts.login)
+    except Exception as e:
+        print(f"Failed to SSH into {host}: {e}")
+        raise failure(e, LOGIN)
+    missing = []
+    try:
         for filename in files:
             try:
                 sftp.stat(filename)
                 print(f"File {filename} found on {host}.")
             except FileNotFoundError:
                 print(f"File {filename} not found on {host}.")
-        sftp.close()
-        client.logout()
+                missing.append(filename)
     except Exception as e:
-        print(f"Failed to SSH into {host}: {e}")
+        print(f"Failed to check files on {host}: {e}")
+        raise failure(e, VERIFY)
+    finally:
+        sftp.close()
+    if missing:
+        raise HostFailure(FILE_MISSING, VERIFY, ', '.join(missing))
 
-def process_host(host, files):
+async def process_host(host, fleet, files, pool):
     """Process a single host: ping and check files."""
-    if ping_host(host):
-        ssh_and_run_commands(host, files)
-        return (host, 'good')
-    else:
-        return (host, 'bad')
-
-def read_hosts_from_csv(csv_file):
-    """Read hosts from the CSV file."""
     try:
-        with open(csv_file, mode='r') as file:
-            csv_reader = csv.DictReader(file, delimiter=',')
-            return [row['SNMP_Host'] for row in csv_reader]
-    except FileNotFoundError:
-        print(f"Error: The file {csv_file} was not found.")
-        exit(1)
-    except Exception as e:
-        print(f"Error reading CSV file {csv_file}: {e}")
-        exit(1)
-
-def process_hosts(hosts, files):
-    good_hosts = []
-    bad_hosts = []
-
-    with ThreadPoolExecutor(max_workers=40) as executor:
-        future_to_host = {executor.submit(process_host, host, files): host for host in hosts}
-        for future in as_completed(future_to_host):
-            host, status = future.result()
-            if status == 'good':
-                good_hosts.append(host)
-            else:
-                bad_hosts.append(host)
+        if not await ping_host(host, fleet):
+            raise HostFailure(UNREACHABLE, REACH)
+        await fleet.run_on_host(host, ssh_and_run_commands, files, pool, fleet.timeouts(host))
+        return (host, 'good')
+    finally:
+        pool.close(host)
 
-    return good_hosts, bad_hosts
+def process_hosts(hosts, files, pool, fleet):
+    return fleet.run(hosts, process_host, files, pool)
 
 def print_hosts(good_hosts, bad_hosts):
     print("Good Hosts:")
@@ -88,19 +61,21 @@ def print_hosts(good_hosts, bad_hosts):
     for host in bad_hosts:
         print(host)
 
-def main(csv_file, files):
+def main(csv_files, selection, files, fleet):
     password = os.getenv('SSH_PASSWORD')
     if not password:
         raise ValueError("No SSH password found. Please set the SSH_PASSWORD environment variable.")
 
-    hosts = read_hosts_from_csv(csv_file)
-    good_hosts, bad_hosts = process_hosts(hosts, files)
+    hosts = read_hosts_from_csv(csv_files, selection)
+    with SSHPool(password, sock_source=fleet.take_socket, profile=fleet.ssh_profile) as pool:
+        good_hosts, bad_hosts = process_hosts(hosts, files, pool, fleet)
     print_hosts(good_hosts, bad_hosts)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Ping hosts and check for specific files via SSH.')
-    parser.add_argument('csv_file', help='Path to the CSV file containing host information.')
+    add_inventory_args(parser)
     parser.add_argument('files', nargs='+', help='Path(s) to the file(s) to be checked.')
+    add_fleet_args(parser, ssh_workers=40)
 
     args = parser.parse_args()
-    main(args.csv_file, args.files)
\ No newline at end of file
+    main(inventory_files(args), selection_from_args(args), args.files, fleet_from_args(args))
\ No newline at end of file
@@ -5,45 +5,54 @@ validate the IP addresses, and log the results. It processes multiple hosts conc
 and reads host information from a CSV file.
 Modules Used:
 --------------
-- csv: To read host information from a CSV file.
-- subprocess: To ping hosts and check their reachability.
+- inventory: To read host information from one or more CSV files.
 - argparse: To handle command-line arguments.
 - logging: To log messages for debugging and tracking.
-- concurrent.futures: To process multiple hosts concurrently.
-- pexpect.pxssh: To handle SSH connections.
+- fleet: To process multiple hosts concurrently with asyncio.
+- ssh_pool / remote_cmd: To run commands over non-interactive SSH exec channels.
+- fleet_state: To record the NTP servers seen on each AP.
+- results: To write a reason-coded results CSV for the run.
 - os: To access environment variables.
 - re: To validate IP addresses using regular expressions.
-- platform: To determine the operating system for ping command compatibility.
 Functions:
 ----------
-1. ping_host(host):
+1. ping_host(host, fleet):
     - Pings the given host to check if it is reachable.
     - Returns True if the host is reachable, otherwise False.
-2. ssh_and_run_commands(host):
-    - SSH into the given host, run a command to retrieve NTP server information, 
-      and validate the IP addresses.
+2. ssh_and_run_commands(host, pool, timeouts):
+    - Run a command on the given host over an SSH exec channel (no pty, no prompt
+      matching) to retrieve NTP server information, and validate the IP addresses.
+    - Login and command timeouts come from the host's measured RTT.
     - Logs valid and invalid IP addresses and handles errors during SSH login.
-3. process_host(host):
-    - Combines ping and SSH operations for a single host.
+    - Returns the list of valid NTP server IPs, or None if none could be read.
+    - Raises HostFailure with the reason and phase if the login or command fails.
+3. process_host(host, fleet, pool, state):
+    - Coroutine combining ping and SSH operations for a single host.
+    - Records the NTP servers seen in the fleet state store.
     - Returns a tuple (host, status) where status is 'good' if the host is reachable 
-      and SSH commands succeed, otherwise 'bad'.
-4. read_hosts_from_csv(csv_file):
-    - Reads host information from a CSV file.
-    - Expects a column named 'SNMP_Host' containing hostnames or IP addresses.
-    - Returns a list of hosts.
-5. process_hosts(hosts):
-    - Processes all hosts concurrently using a thread pool.
+      and SSH commands succeed; otherwise raises HostFailure and the host is 'bad'.
+4. read_hosts_from_csv(csv_files) (from inventory):
+    - Streams host information from one or more CSV files ('-' for stdin).
+    - Expects a column named 'SNMP_Host' containing IP addresses.
+    - Yields each valid address once, skipping invalid entries and duplicates.
+    - --exclude/--intersect/--cidr/--octet/--limit narrow the selected hosts.
+    - --retry-from results.csv [--reason timeout] keeps only the hosts that failed in an earlier run.
+5. process_hosts(hosts, pool, fleet, state):
+    - Processes all hosts concurrently on the asyncio fleet engine.
     - Returns two lists: good_hosts (reachable and processed successfully) 
       and bad_hosts (unreachable or failed processing).
 6. print_hosts(good_hosts, bad_hosts):
     - Prints and logs the lists of good and bad hosts.
-7. main(csv_file):
+7. main(csv_files, selection, fleet, state, mux=None):
     - Main function to orchestrate the script's operations.
-    - Reads the CSV file, processes the hosts, and prints the results.
+    - Reads the CSV files, processes the hosts, and prints the results.
+    - Each host's status, failure reason, phase and elapsed time are written to
+      ap_test_for_ntp_results.csv (--results), in the same 'SNMP_Host' CSV format.
+    - With --openssh the sessions ride per-AP OpenSSH ControlMaster connections (ssh_mux.py).
 Usage:
 ------
 - Run the script from the command line with a CSV file as an argument:
-    ./ap_test_for_ntp.py <path_to_csv_file>
+    ./ap_test_for_ntp.py <path_to_csv_file> [--csv <another_csv_file> ...]
 - The CSV file must contain a column named 'SNMP_Host'.
 - Set the SSH password in the environment variable 'SSH_PASSWORD' before running the script:
     export SSH_PASSWORD=your_password
@@ -53,7 +62,11 @@ Logging:
 - Modify the logging level in the main() function to enable logging for debugging.
 Concurrency:
 ------------
-- The script uses a ThreadPoolExecutor with a maximum of 40 workers to process hosts concurrently.
+- The script runs one coroutine per host and allows at most 40 concurrent SSH sessions
+  by default (--max-ssh); pings are bounded separately (--max-ping).
+- Sessions of all the tools running on the controller together are capped by
+  --max-ssh-global, and APs another tool is upgrading or copying to are skipped
+  with reason 'busy' instead of being logged into.
 Error Handling:
 ---------------
 - Handles errors during CSV file reading, SSH login, and command execution.
@@ -61,41 +74,40 @@ Error Handling:
 """
 #
 
-import subprocess
 import argparse
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pexpect import pxssh
+import paramiko
 import os
 import re
-import platform
-import csv
+from ssh_mux import add_mux_args, mux_from_args, open_pool
+from remote_cmd import run_command
+from fleet import add_fleet_args, fleet_from_args
+from inventory import add_inventory_args, inventory_files, read_hosts_from_csv, selection_from_args
+from fleet_state import NTP_SEEN, add_state_args, state_from_args
+from results import COMMAND, COMMAND_ERROR, LOGIN, REACH, UNREACHABLE, HostFailure, failure
 
-def ping_host(host):
+# Exec channels get no login-shell PATH, so the full path is spelled out.
+NU_CONFIG_COMMAND = '/onramp/bin/web_ctrl request_nu_config'
+
+async def ping_host(host, fleet):
     """Ping the host to check if it is reachable."""
-    try:
-        ping_flag = '-n' if platform.system().lower() == 'windows' else '-c'
-        subprocess.check_output(['ping', ping_flag, '1', host], stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return await fleet.ping(host)
     
-def ssh_and_run_commands(host):
+def ssh_and_run_commands(host, pool, timeouts):
     """SSH into the host, run the specified command, and report the NTP server information."""
     try:
-        client = pxssh.pxssh()
-        username = 'root'
-        password = os.getenv('SSH_PASSWORD')
-        if not password:
-            raise ValueError("No SSH password found. Please set the SSH_PASSWORD environment variable (e.g., export SSH_PASSWORD=your_password).")
-        if not client.login(host, username, password):
-            logging.error(f"SSH login failed for {host}")
-            return
-
-        # Run the command "web_ctrl request_nu_config"
-        client.sendline('web_ctrl request_nu_config')
-        client.prompt()
-        output = client.before.decode('utf-8')
+        client = pool.get(host, timeout=timeouts.login)
+    except Exception as e:
+        logging.error(f"Failed to SSH into {host}: {e}")
+        raise failure(e, LOGIN)
+    try:
+        # Run the command "/onramp/bin/web_ctrl request_nu_config"
+        result = run_command(client, NU_CONFIG_COMMAND, timeout=timeouts.command)
+        if result.exit_status != 0:
+            logging.error(f"{host}, web_ctrl exited with status {result.exit_status}: {result.stderr.strip()}")
+            raise HostFailure(COMMAND_ERROR, COMMAND,
+                              f"web_ctrl exited with status {result.exit_status}: {result.stderr.strip()}")
+        output = result.stdout
         #print(output)
 
         # Extract the content of the <ntpServers> line
@@ -133,60 +145,35 @@ def ssh_and_run_commands(host):
                 logging.info(f"{host}, Valid NTP server IP(s): {', '.join(valid_ips)}")
             if invalid_ips:
                 logging.warning(f"{host}, Invalid NTP server IP(s): {', '.join(invalid_ips)}")
+            return valid_ips
         else:
             logging.warning(f"{host}, <ntpServers> not found")
-
-        client.logout()
-    except pxssh.ExceptionPxssh as e:
-        logging.error(f"Failed to SSH into {host}: {e}")
+    except HostFailure:
+        raise
+    except (paramiko.SSHException, OSError) as e:
+        logging.error(f"Failed to run the command on {host}: {e}")
+        raise failure(e, COMMAND)
     except ValueError as e:
         print(f"Value error for {host}: {e}")
+        raise failure(e, COMMAND)
     except Exception as e:
         print(f"An unexpected error occurred for {host}: {e}")
+        raise failure(e, COMMAND)
 
-def process_host(host):
+async def process_host(host, fleet, pool, state):
     """Process a single host: ping and run the command."""
-    if ping_host(host):
-        ssh_and_run_commands(host)
-        return (host, 'good')
-    else:
-        return (host, 'bad')
-
-def read_hosts_from_csv(csv_file):
-    """Read hosts from the CSV file."""
     try:
-        with open(csv_file, mode='r') as file:
-            csv_reader = csv.DictReader(file)
-            if 'SNMP_Host' not in csv_reader.fieldnames:
-                raise ValueError(f"The CSV file {csv_file} does not contain the required 'SNMP_Host' column.")
-            return [row['SNMP_Host'] for row in csv_reader]
-    except FileNotFoundError:
-        logging.error(f"Error: The file {csv_file} was not found.")
-        print(f"Error: The file {csv_file} was not found.")
-        exit(1)
-    except Exception as e:
-        logging.error(f"Error reading CSV file {csv_file}: {e}")
-        print(f"Error reading CSV file {csv_file}: {e}")
-        exit(1)
-        print(f"Error reading CSV file {csv_file}: {e}")
-        exit(1)
-    except Exception as e:
-        print(f"Error reading CSV file {csv_file}: {e}")
-        exit(1)
+        if not await ping_host(host, fleet):
+            raise HostFailure(UNREACHABLE, REACH)
+        valid_ips = await fleet.run_on_host(host, ssh_and_run_commands, pool, fleet.timeouts(host))
+        state.record(host, NTP_SEEN, bool(valid_ips), ', '.join(valid_ips or []))
+        return (host, 'good')
+    finally:
+        pool.close(host)
 
-def process_hosts(hosts):
+def process_hosts(hosts, pool, fleet, state):
     """Process all hosts concurrently."""
-    good_hosts = []
-    bad_hosts = []
-    with ThreadPoolExecutor(max_workers=40) as executor:
-        future_to_host = {executor.submit(process_host, host): host for host in hosts}
-        for future in as_completed(future_to_host):
-            host, status = future.result()
-            if status == 'good':
-                good_hosts.append(host)
-            else:
-                bad_hosts.append(host)
-    return good_hosts, bad_hosts
+    return fleet.run(hosts, process_host, pool, state)
 
 def print_hosts(good_hosts, bad_hosts):
     """Print the good and bad hosts."""
@@ -203,7 +190,7 @@ def print_hosts(good_hosts, bad_hosts):
         logging.info(host)
         print(host)  # Only one print statement
 
-def main(csv_file):
+def main(csv_files, selection, fleet, state, mux=None):
     """Main function to process the hosts."""
     # Disable logging by setting the level to CRITICAL
     logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -211,12 +198,17 @@ def main(csv_file):
     password = os.getenv('SSH_PASSWORD')
     if not password:
         raise ValueError("No SSH password found. Please set the SSH_PASSWORD environment variable.")
-    hosts = read_hosts_from_csv(csv_file)
-    good_hosts, bad_hosts = process_hosts(hosts)
+    hosts = read_hosts_from_csv(csv_files, selection)
+    with open_pool(password, fleet, mux) as pool, state:
+        good_hosts, bad_hosts = process_hosts(hosts, pool, fleet, state)
     print_hosts(good_hosts, bad_hosts)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Ping hosts and extract NTP server information via SSH.')
-    parser.add_argument('csv_file', help='Path to the CSV file containing host information.')
+    add_inventory_args(parser)
+    add_fleet_args(parser, ssh_workers=40)
+    add_state_args(parser)
+    add_mux_args(parser)
     args = parser.parse_args()
-    main(args.csv_file)
+    main(inventory_files(args), selection_from_args(args), fleet_from_args(args), state_from_args(args),
+         mux_from_args(args))
@@ -2,154 +2,143 @@
 # ap_upgrade_ccs3.py
 # This script pushes an upgrade script to a list of hosts.
 # The hosts are read from a CSV file.
-# The script uses the pexpect library to SSH into the hosts and run the upgrade script.
-# The script uses the ThreadPoolExecutor to process multiple hosts concurrently.
-# The script also uses the subprocess library to ping the hosts before pushing the upgrade.
+# The script uses the shared paramiko connection pool to SSH into the hosts and run the upgrade script.
+# The script uses the asyncio fleet engine to process multiple hosts concurrently.
+# The script also pings the hosts before pushing the upgrade.
 # The script prints the list of good and bad hosts at the end.
+# Each host's failure reason, phase and elapsed time are written to a results CSV (--results).
 
-import csv
-import subprocess
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
-from pexpect import pxssh
 import time
-
-def ping_host(host):
+from ssh_mux import add_mux_args, mux_from_args, open_pool
+from fleet import add_fleet_args, fleet_from_args
+from inventory import add_inventory_args, inventory_files, read_hosts_from_csv, selection_from_args
+from work_queue import add_queue_args
+from fleet_state import UPGRADE_COMPLETED, UPGRADE_LAUNCHED, add_state_args, state_from_args
+from remote_cmd import run_command
+from command_plan import CommandPlan
+from results import (COMMAND, COMMAND_ERROR, FILE_MISSING, LOGIN, REACH, UNREACHABLE, VERIFY, HostFailure,
+                     failure)
+
+UPGRADE_TIMEOUT = 600  # The upgrade script can take up to 10 minutes
+UPGRADE_SCRIPT = "/tmp/yocto_ap6_upgrade.sh"
+UPGRADE_COMMAND = "echo ./yocto_ap6_upgrade.sh ap5_fw_10_5_5_135352_135354M.dist"
+# Launches are recorded against the command text, so a dry run ('echo ...')
+# never makes the real upgrade skip an AP as already launched.
+UPGRADED_CHECK = "grep -q Yocto /etc/issue"
+WEB_CTRL_COMMAND = "/onramp/bin/web_ctrl set_tcp_config -t 0 -m 0 -s 192.168.0.1 -p 5051 -h 192.168.30.107"
+
+async def ping_host(host, fleet):
     """Ping the host to check if it is reachable."""
-    try:
-        subprocess.check_output(['ping', '-c', '1', host], stderr=subprocess.STDOUT)
+    if await fleet.ping(host):
         return True
-    except subprocess.CalledProcessError:
-        print(f"Host {host} is not reachable.")
-        return False
-
-def push_upgrade(host):
-    """Push upgrade script to the host using SSH."""
+    print(f"Host {host} is not reachable.")
+    return False
+
+def build_upgrade_plan():
+    """Build the command plan that is run on each AP in a single round trip."""
+    plan = CommandPlan(cwd='/tmp')
+    # Stop here if the AP already runs the yocto distribution
+    plan.add('not_upgraded', f"! {UPGRADED_CHECK}")
+    # Point the AP at the CCS3 head end
+    plan.add('web_ctrl', WEB_CTRL_COMMAND, stop_on_error=False)
+    # The upgrade script must have been copied and must be executable
+    plan.add('script_present', f"test -f {UPGRADE_SCRIPT}")
+    plan.add('chmod', f"chmod 754 {UPGRADE_SCRIPT}")
+    plan.add('script_executable', f"test -x {UPGRADE_SCRIPT}")
+    # Execute the upgrade script with the argument
+    plan.add('upgrade', UPGRADE_COMMAND)
+    return plan
+
+def push_upgrade(host, pool, timeouts):
+    """Push upgrade script to the host using SSH.
+
+    Returns UPGRADE_LAUNCHED, or UPGRADE_COMPLETED if the AP was already upgraded.
+    Raises HostFailure if the login, the plan or the upgrade fails.
+    """
     try:
-        client = pxssh.pxssh(timeout=600)  # Set SSH timeout to 5 minutes (300 seconds)
-        username = 'root'
-        password = os.getenv('SSHPASS')
-        if not password:
-            raise ValueError("No SSH password found. Please set the SSHPASS environment variable.")
-
-        if not client.login(host, username, password):
-            print(f"SSH login failed for {host}")
-            return False
-
-        # Change directory to /tmp
-        cd_command = "cd /tmp"
-        client.sendline(cd_command)
-        client.prompt()
-        time.sleep(2) 
-        output = client.before.decode('utf-8').splitlines()
-        output = [line.strip() for line in output if line.strip()]
-        #print(f"Output from cd /tmp: {output}")
-        # Verify if the file exists before changing permissions
-        web_command = "/onramp/bin/web_ctrl set_tcp_config -t 0 -m 0 -s 192.168.0.1 -p 5051 -h 192.168.30.107"
-        client.sendline(web_command)
-        client.prompt()
-        time.sleep(5)  # Increase delay to ensure the command has enough time to execute
-        output = client.before.decode('utf-8').splitlines()
-        output = [line.strip() for line in output if line.strip()]
-        #print(f"Output before chmod command: {output}")
-        # Verify the current directory
-        pwd_command = "pwd"
-        client.sendline(pwd_command)
-        client.prompt()
-        output = client.before.decode('utf-8').splitlines()
-        output = [line.strip() for line in output if line.strip()]
-        #print(f"Output from pwd command: {output}")
-
-        # Verify if the file exists before changing permissions
-        verify_command = "ls -l /tmp/yocto_ap6_upgrade.sh"
-        client.sendline(verify_command)
-        client.prompt()
-        time.sleep(5)  # Increase delay to ensure the command has enough time to execute
-        output = client.before.decode('utf-8').splitlines()
-        output = [line.strip() for line in output if line.strip()]
-        #print(f"Output before chmod command: {output}")
-
-        # Check if permissions need to be changed
-        if len(output) > 1 and '-rwxr-xr--' not in output[1]:
-            # Execute the chmod command
-            chmod_command = "chmod 754 /tmp/yocto_ap6_upgrade.sh"
-            client.sendline(chmod_command)
-            client.prompt()
-            time.sleep(2)  # Increase delay to ensure the command has enough time to execute
-            output = client.before.decode('utf-8').splitlines()
-            output = [line.strip() for line in output if line.strip()]
-            #print(f"Output from chmod command: {output}")
-
-            # Verify if the file permissions were changed
-            client.sendline(verify_command)
-            client.prompt()
-            output = client.before.decode('utf-8').splitlines()
-            output = [line.strip() for line in output if line.strip()]
-            print(f"Output after chmod command: {output}")
-        else:
-            print(" ")
-            #print("Permissions are already set correctly or file does not exist.")
-
-        # Execute the upgrade script with the argument
-        command = "echo ./yocto_ap6_upgrade.sh ap5_fw_10_5_5_135352_135354M.dist"
-        client.sendline(command)
-        client.prompt()
-        output = client.before.decode('utf-8').splitlines()
-        output = [line.strip() for line in output if line.strip()]
-        print(f"Output from command: {output}")
-
-        # Record the time
-        print(f"Command executed at: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-
-        client.logout()
-        return True
+        client = pool.get(host, timeout=timeouts.login)
     except Exception as e:
         print(f"Failed to SSH into {host}: {e}")
-        return False
+        raise failure(e, LOGIN)
+    try:
+        result = build_upgrade_plan().run(client, timeout=max(UPGRADE_TIMEOUT, timeouts.command))
+    except Exception as e:
+        print(f"Failed to run the upgrade on {host}: {e}")
+        raise failure(e, COMMAND)
 
-def process_host(host):
-    """Process a single host: ping and push upgrade."""
-    if ping_host(host):
-        if push_upgrade(host):
-            return (host, 'good')
-        else:
-            return (host, 'bad')
-    else:
-        return (host, 'bad')
+    if result['not_upgraded'].exit_status == 1:
+        print(f"{host} has already been upgraded to the yocto distribution.")
+        return UPGRADE_COMPLETED
+
+    for step in result:
+        if step.exit_status not in (0, None):
+            output = [line.strip() for line in (step.stdout + step.stderr).splitlines() if line.strip()]
+            print(f"Step {step.name} failed on {host} with exit status {step.exit_status}: {output}")
+
+    upgrade = result['upgrade']
+    if upgrade.exit_status != 0:
+        if result['script_present'].exit_status not in (0, None):
+            raise HostFailure(FILE_MISSING, COMMAND, UPGRADE_SCRIPT)
+        ran = [step for step in result if step.exit_status is not None]
+        if not ran:
+            raise HostFailure(COMMAND_ERROR, COMMAND, result.stderr)
+        raise HostFailure(COMMAND_ERROR, COMMAND, f"step {ran[-1].name} exited with status {ran[-1].exit_status}")
+
+    output = [line.strip() for line in (upgrade.stdout + upgrade.stderr).splitlines() if line.strip()]
+    print(f"Output from command: {output}")
+
+    # Record the time
+    print(f"Command executed at: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    return UPGRADE_LAUNCHED
 
-def read_hosts_from_csv(csv_file):
-    """Read hosts from the CSV file."""
+def check_upgraded(host, pool, timeouts):
+    """Return True if the host now runs the yocto distribution, False if not.
+
+    Raises HostFailure if the host cannot be checked.
+    """
     try:
-        print(f"Reading hosts from CSV file: {csv_file}")
-        with open(csv_file, mode='r') as file:
-            csv_reader = csv.DictReader(file, delimiter=',')
-            if 'SNMP_Host' not in csv_reader.fieldnames:
-                raise ValueError("CSV file is missing 'SNMP_Host' header.")
-            return [row['SNMP_Host'] for row in csv_reader]
-    except FileNotFoundError:
-        print(f"Error: The file {csv_file} was not found.")
-        exit(1)
+        client = pool.get(host, timeout=timeouts.login)
     except Exception as e:
-        print(f"Error reading CSV file {csv_file}: {e}")
-        exit(1)
-
-def process_hosts(hosts):
+        print(f"Failed to SSH into {host}: {e}")
+        raise failure(e, LOGIN)
+    try:
+        return run_command(client, UPGRADED_CHECK, timeout=timeouts.command).exit_status == 0
+    except Exception as e:
+        print(f"Failed to check the upgrade on {host}: {e}")
+        raise failure(e, VERIFY)
+
+async def process_host(host, fleet, pool, state):
+    """Process a single host: ping and push upgrade, unless it was already launched or completed."""
+    if state.done(host, UPGRADE_COMPLETED):
+        print(f"Skipping {host}: upgrade already completed.")
+        return (host, 'good')
+    try:
+        if not await ping_host(host, fleet):
+            raise HostFailure(UNREACHABLE, REACH)
+        if state.done(host, UPGRADE_LAUNCHED, UPGRADE_COMMAND):
+            # Never relaunch an upgrade that may still be flashing; only look for its completion.
+            if await fleet.run_on_host(host, check_upgraded, pool, fleet.timeouts(host)):
+                state.record(host, UPGRADE_COMPLETED, True)
+            else:
+                print(f"Skipping {host}: upgrade already launched.")
+            return (host, 'good')
+        try:
+            outcome = await fleet.run_on_host(host, push_upgrade, pool, fleet.timeouts(host), exclusive=True)
+        except HostFailure:
+            state.record(host, UPGRADE_LAUNCHED, False, UPGRADE_COMMAND)
+            raise
+        state.record(host, outcome, True, UPGRADE_COMMAND if outcome == UPGRADE_LAUNCHED else '')
+        return (host, 'good')
+    finally:
+        pool.close(host)
+
+def process_hosts(hosts, pool, fleet, state):
     """Process all hosts concurrently."""
     print("Processing all hosts concurrently.")
-    good_hosts = []
-    bad_hosts = []
-
-    with ThreadPoolExecutor(max_workers=25) as executor:
-        future_to_host = {executor.submit(process_host, host): host for host in hosts}
-        for future in as_completed(future_to_host):
-            host, status = future.result()
-            if status == 'good':
-                good_hosts.append(host)
-            else:
-                bad_hosts.append(host)
-
-    return good_hosts, bad_hosts
+    return fleet.run(hosts, process_host, pool, state)
 
 def print_hosts(good_hosts, bad_hosts):
     """Print the lists of good and bad hosts."""
@@ -160,28 +149,17 @@ def print_hosts(good_hosts, bad_hosts):
     for host in bad_hosts:
         print(host)
 
-def main(csv_file):
+def main(csv_files, selection, fleet, state, mux=None):
     password = os.getenv('SSHPASS')
     if not password:
         raise ValueError("No SSH password found. Please set the SSHPASS environment variable.")
 
-    print(f"Reading hosts from CSV file: {csv_file}")
-    good_hosts = []
-    bad_hosts = []
-
-    with open(csv_file, mode='r') as file:
-        csv_reader = csv.DictReader(file, delimiter=',')
-        hosts = [row['SNMP_Host'] for row in csv_reader]
+    print(f"Reading hosts from CSV file: {', '.join(csv_files)}")
+    hosts = read_hosts_from_csv(csv_files, selection)
 
     print("Starting to process hosts.")
-    with ThreadPoolExecutor(max_workers=12) as executor:
-        future_to_host = {executor.submit(process_host, host): host for host in hosts}
-        for future in as_completed(future_to_host):
-            host, status = future.result()
-            if status == 'good':
-                good_hosts.append(host)
-            else:
-                bad_hosts.append(host)
+    with open_pool(password, fleet, mux) as pool, state:
+        good_hosts, bad_hosts = fleet.run(hosts, process_host, pool, state)
 
     print("Good Hosts:")
     for host in good_hosts:
@@ -193,7 +171,12 @@ def main(csv_file):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Push run upgrade script to hosts listed in a CSV file.')
-    parser.add_argument('csv_file', help='Path to the CSV file containing host information.')
+    add_inventory_args(parser)
+    add_fleet_args(parser, ssh_workers=12)
+    add_state_args(parser)
+    add_queue_args(parser)
+    add_mux_args(parser)
 
     args = parser.parse_args()
-    main(args.csv_file)
\ No newline at end of file
+    main(inventory_files(args), selection_from_args(args), fleet_from_args(args), state_from_args(args),
+         mux_from_args(args))
\ No newline at end of file
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# artifact_server.py
+# Pull-based distribution: a small HTTP server on the controller that the
+# APs fetch the artifacts from with their own wget or curl.
+# Sending a multi-megabyte .dist over SFTP makes the AP6's PowerPC CPU
+# decrypt every byte, so the CPU and not the link limits each upload. Over
+# plain HTTP the AP only writes the file and hashes it once.
+#
+# The fetch runs in the background on the AP (nohup), so no SSH session or
+# worker thread waits for it: one short session starts it, later ones poll
+# its status file every FETCH_POLL seconds, and a last one verifies the
+# files. How many APs fetch at once is bounded separately from --max-ssh.
+#
+# The server only hands out the artifacts of the run, under a random
+# per-run token ('/<token>/<name>'), supports byte ranges so an interrupted
+# fetch resumes with wget -c / curl -C -, and draws on the bandwidth
+# governor for every chunk it sends. Chunks are slices of the artifact's
+# shared mapping. Fetched files land in '<name>.part' and are renamed into
+# place only once their digest matches.
+
+import hmac
+import os
+import secrets
+import shlex
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+from artifacts import file_digest, remote_digests, shared_buffer
+from remote_cmd import CommandTimeout, run_command
+from sftp_upload import Transfer, finish_parts, staging_paths
+
+CHUNK_SIZE = 65536
+FETCH_TIMEOUT = 600
+FETCH_POLL = 5
+MAX_FETCHES = 200
+
+# Run on the AP in a subshell with $url and $part set; exits 127 if it has
+# neither tool. The tool replaces the subshell, so its pid is the tool's.
+FETCH_COMMAND = ('if command -v wget >/dev/null 2>&1; then exec wget -q -c -O "$part" "$url"; '
+                 'elif command -v curl >/dev/null 2>&1; then exec curl -fsS -C - -o "$part" "$url"; '
+                 'else exit 127; fi')
+FETCH_TOOLS = '{ command -v wget || command -v curl; } >/dev/null 2>&1'
+
+# A fetch started on an AP: the files it is fetching ('missing'), the status
+# file its exit status is written to, and the pid of the background shell.
+Fetch = namedtuple('Fetch', ['file_paths', 'destination', 'algorithm', 'missing', 'status', 'pid', 'started',
+                             'deadline'])
+
+
+class FetchUnavailable(Exception):
+    """Raised when an AP cannot fetch files over HTTP or verify them, so they must be uploaded instead."""
+
+
+def parse_range(header, size):
+    """Return the (start, end) byte range, end inclusive, asked for by a Range header.
+
+    Returns None for a missing or unsupported header (send the whole file)
+    and raises ValueError for a range that lies outside the file.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(f"range {header} outside {size} bytes")
+    return start, end
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'ap_ccs3'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _artifact(self):
+        _, token, name = (self.path.split('/', 2) + ['', ''])[:3]
+        artifacts = self.server.artifacts
+        if not hmac.compare_digest(token.encode(), artifacts.token.encode()):
+            return None
+        return artifacts.files.get(unquote(name))
+
+    def _send(self, body):
+        path = self._artifact()
+        if path is None:
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        try:
+            byte_range = parse_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{size}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if byte_range:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if body:
+            self._copy(path, start, end - start + 1)
+
+    def _copy(self, path, offset, length):
+        governor = self.server.artifacts.governor
+        host = self.client_address[0]
+        buffer = shared_buffer(path)
+        for position in range(offset, offset + length, CHUNK_SIZE):
+            chunk = buffer[position:min(position + CHUNK_SIZE, offset + length)]
+            if governor is not None and governor.enabled:
+                governor.throttle(host, len(chunk))
+            try:
+                self.wfile.write(chunk)
+            except ConnectionError:
+                # The AP gave up; it resumes with a range request next time.
+                return
+
+    def do_GET(self):
+        self._send(body=True)
+
+    def do_HEAD(self):
+        self._send(body=False)
+
+
+class ArtifactServer:
+    """HTTP server for the artifacts of one run, started with start() and stopped with close()."""
+
+    def __init__(self, bind='', port=0, max_fetches=MAX_FETCHES):
+        self.bind = bind
+        self.port = port
+        self.max_fetches = max_fetches
+        self.token = secrets.token_urlsafe(16)
+        self.files = {}
+        self.governor = None
+        self._httpd = None
+        self._thread = None
+
+    def start(self, file_paths, governor=None):
+        """Serve the files, by base name, in a background thread."""
+        self.files = {os.path.basename(path): path for path in file_paths}
+        self.governor = governor
+        self._httpd = ThreadingHTTPServer((self.bind, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.artifacts = self
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def base_url(self, client):
+        """Return the URL the AP behind client reaches the server at.
+
+        The controller address is the local end of the AP's SSH connection,
+        which is the address the AP can route back to.
+        """
+        if hasattr(client, 'local_address'):
+            # ssh_mux clients have no socket of their own to ask.
+            address = client.local_address()
+        else:
+            address = client.get_transport().sock.getsockname()[0]
+        if ':' in address:
+            address = f"[{address}]"
+        return f"http://{address}:{self.port}/{self.token}"
+
+    def close(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+def start_fetch(client, server, file_paths, destination, algorithm='sha256', timeout=None,
+                fetch_timeout=FETCH_TIMEOUT):
+    """Start the AP fetching the files from the ArtifactServer into the destination, in the background.
+
+    Files already there with the right digest, or fully fetched into their
+    .part, are not fetched again. Returns a Fetch (pid None if there is
+    nothing to fetch). Raises FetchUnavailable if the AP has no wget or
+    curl, or cannot compute digests.
+    """
+    remote_paths, part_paths = staging_paths(file_paths, destination)
+    local = {path: file_digest(path, algorithm) for path in file_paths}
+
+    remote = remote_digests(client, list(remote_paths.values()) + list(part_paths.values()), algorithm, timeout)
+    if remote is None:
+        raise FetchUnavailable(f"no {algorithm}sum on the AP")
+    missing = [path for path in file_paths if remote.get(remote_paths[path]) != local[path]]
+    to_fetch = [path for path in missing if remote.get(part_paths[path]) != local[path]]
+    status = f"{destination}/.fetch.{secrets.token_hex(6)}"
+    started = time.monotonic()
+    if not to_fetch:
+        return Fetch(file_paths, destination, algorithm, missing, status, None, started, None)
+
+    # finish writes the exit status atomically and ends the script; a
+    # cancelled fetch (TERM) stops the tool too.
+    lines = [f"status={shlex.quote(status)}",
+             'finish() { echo "$1" > "$status.tmp" && mv -f "$status.tmp" "$status"; exit; }',
+             "trap 'kill $child 2>/dev/null; exit 143' TERM"]
+    base_url = server.base_url(client)
+    for path in to_fetch:
+        size = os.path.getsize(path)
+        # A partial file as long as the artifact cannot be resumed, only replaced.
+        lines.append(f"part={shlex.quote(part_paths[path])} "
+                     f"url={shlex.quote(f'{base_url}/{quote(os.path.basename(path))}')}; "
+                     f"if [ -f \"$part\" ] && [ \"$(wc -c < \"$part\")\" -ge {size} ]; then rm -f \"$part\"; fi; "
+                     f"( {FETCH_COMMAND} ) & child=$!; wait $child || finish $?")
+    lines.append("finish 0")
+    result = run_command(client, f"{FETCH_TOOLS} || exit 127; "
+                                 f"nohup sh -c {shlex.quote(chr(10).join(lines))} "
+                                 f"</dev/null >/dev/null 2>{shlex.quote(status + '.err')} & echo $!",
+                         timeout=timeout)
+    if result.exit_status == 127:
+        raise FetchUnavailable("no wget or curl on the AP")
+    if result.exit_status != 0 or not result.stdout.strip().isdigit():
+        raise IOError(f"could not start the fetch: {result.stderr.strip()}")
+    return Fetch(file_paths, destination, algorithm, missing, status, int(result.stdout.strip()), started,
+                 started + fetch_timeout)
+
+
+def _clean_up(client, fetch, timeout):
+    status = shlex.quote(fetch.status)
+    run_command(client, f"rm -f {status} {status}.err {status}.tmp", timeout=timeout)
+
+
+def fetch_done(client, fetch, timeout=None):
+    """Return True once the fetch has finished, False while it is still running.
+
+    Raises FetchUnavailable if the AP turned out to have no wget or curl,
+    IOError if the fetch failed or died, and CommandTimeout (after stopping
+    it) if it ran past its deadline.
+    """
+    if fetch.pid is None:
+        return True
+    status = shlex.quote(fetch.status)
+    result = run_command(client, f"if [ -f {status} ]; then cat {status} {status}.err 2>/dev/null; "
+                                 f"elif kill -0 {fetch.pid} 2>/dev/null; then echo running; fi", timeout=timeout)
+    first, _, errors = result.stdout.partition('\n')
+    first = first.strip()
+    if first == 'running':
+        if time.monotonic() > fetch.deadline:
+            cancel_fetch(client, fetch, timeout)
+            raise CommandTimeout(f"fetch did not finish within {fetch.deadline - fetch.started:.0f} seconds")
+        return False
+    _clean_up(client, fetch, timeout)
+    if first == '0':
+        return True
+    if first == '127':
+        raise FetchUnavailable("no wget or curl on the AP")
+    if not first:
+        raise IOError("fetch stopped without an exit status")
+    raise IOError(f"fetch exited with status {first}: {errors.strip()}")
+
+
+def cancel_fetch(client, fetch, timeout=None):
+    """Stop a fetch that is still running; its .part files are kept so a later fetch resumes them."""
+    if fetch.pid is not None:
+        run_command(client, f"kill {fetch.pid} 2>/dev/null", timeout=timeout)
+        _clean_up(client, fetch, timeout)
+
+
+def finish_fetch(client, fetch, timeout=None):
+    """Verify the fetched files and rename them into place.
+
+    Returns a Transfer per file, in the order given (sent is 0 for files
+    already present). Raises ChecksumMismatch if a fetched file is wrong and
+    IOError if the files cannot be renamed.
+    """
+    remote_paths = staging_paths(fetch.file_paths, fetch.destination)[0]
+    seconds = time.monotonic() - fetch.started
+    finish_parts(client, fetch.missing, fetch.destination, fetch.algorithm, timeout, how='fetch')
+
+    return [Transfer(path, remote_paths[path], os.path.getsize(path), seconds if path in fetch.missing else 0.0,
+                     os.path.getsize(path) if path in fetch.missing else 0)
+            for path in fetch.file_paths]
+
+
+def add_http_args(parser):
+    """Add the options for serving the artifacts to the APs over HTTP."""
+    group = parser.add_argument_group('HTTP distribution')
+    group.add_argument('--http', action='store_true',
+                       help='Serve the files over HTTP from this controller and have each AP fetch them with '
+                            'wget/curl instead of uploading them over SFTP.')
+    group.add_argument('--http-bind', default='', metavar='ADDRESS',
+                       help='Address the HTTP server listens on (default: all).')
+    group.add_argument('--http-port', type=int, default=0, metavar='PORT',
+                       help='Port the HTTP server listens on (default: any free port).')
+    group.add_argument('--max-fetches', type=int, default=MAX_FETCHES, metavar='N',
+                       help=f'Maximum APs fetching at once; fetches run in the background on the AP and hold '
+                            f'no SSH session (default: {MAX_FETCHES}).')
+
+
+def server_from_args(args):
+    """Build the ArtifactServer described by the add_http_args options, or None without --http."""
+    if not args.http:
+        return None
+    return ArtifactServer(args.http_bind, args.http_port, args.max_fetches)
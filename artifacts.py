@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# artifacts.py
+# Digests of the firmware artifacts, locally and on the AP.
+# Local digests are cached on disk by path, size and mtime, so a
+# multi-megabyte .dist is hashed once and not on every run or for every AP.
+# Remote digests come from one sha256sum/sha512sum run over all the files on
+# the AP's pooled connection. The copy tool uses both to send only what is
+# missing or different, and to prove a finished copy is intact.
+#
+# The artifacts themselves are mapped into memory once per process, read
+# only, and every upload and hash reads memoryview slices of that one
+# mapping, so forty or a thousand concurrent transfers share the same pages
+# instead of each reading its own copy from disk. An artifact must not be
+# rewritten in place while a tool is running; replacing the file (new inode)
+# is fine and gets a fresh mapping.
+
+import hashlib
+import json
+import mmap
+import os
+import shlex
+import threading
+
+from remote_cmd import run_command
+
+DIGEST_ALGORITHMS = ('sha256', 'sha512')
+
+_lock = threading.Lock()
+_memo = {}
+_buffer_lock = threading.Lock()
+_buffers = {}
+
+
+def default_digest_cache_path():
+    """Return the per-user digest cache file location."""
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ap_ccs3', 'digests.json')
+
+
+def _read_cache(path):
+    try:
+        with open(path) as file:
+            entries = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def _write_cache(path, entries):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(entries, file)
+    os.replace(temp_path, path)
+
+
+def shared_buffer(file_path):
+    """Return a read-only memoryview of the whole file, mapped once and shared by every reader."""
+    key = os.path.realpath(file_path)
+    stat = os.stat(key)
+    stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _buffer_lock:
+        entry = _buffers.get(key)
+        if entry is None or entry[0] != stamp:
+            if stat.st_size:
+                with open(key, 'rb') as file:
+                    view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                # Empty files cannot be mapped.
+                view = memoryview(b'')
+            entry = _buffers[key] = (stamp, view)
+        return entry[1]
+
+
+def file_digest(file_path, algorithm='sha256', cache_path=None):
+    """Return the hex digest of a local file, from the cache while the file is unchanged."""
+    cache_path = cache_path or default_digest_cache_path()
+    stat = os.stat(file_path)
+    key = f"{algorithm}:{os.path.realpath(file_path)}"
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    with _lock:
+        entry = _memo.get(key)
+        if entry is None or entry['stamp'] != stamp:
+            entry = _read_cache(cache_path).get(key)
+        if entry is not None and entry['stamp'] == stamp:
+            _memo[key] = entry
+            return entry['digest']
+
+        entry = {'stamp': stamp, 'digest': hashlib.new(algorithm, shared_buffer(file_path)).hexdigest()}
+        _memo[key] = entry
+        entries = _read_cache(cache_path)
+        entries[key] = entry
+        _write_cache(cache_path, entries)
+        return entry['digest']
+
+
+def prefix_digest(file_path, length, algorithm='sha256'):
+    """Return the hex digest of the first length bytes of a local file."""
+    return hashlib.new(algorithm, shared_buffer(file_path)[:length]).hexdigest()
+
+
+def remote_digests(client, remote_paths, algorithm='sha256', timeout=None):
+    """Return {remote_path: hex digest} for the files that exist on the AP.
+
+    Returns None if the AP has no <algorithm>sum command.
+    """
+    if not remote_paths:
+        return {}
+    command = f"{algorithm}sum {' '.join(shlex.quote(path) for path in remote_paths)}"
+    result = run_command(client, command, timeout=timeout)
+    if result.exit_status == 127:
+        return None
+    digests = {}
+    for line in result.stdout.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2 and parts[1].lstrip('*') in remote_paths:
+            digests[parts[1].lstrip('*')] = parts[0].lower()
+    return digests
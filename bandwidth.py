@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# bandwidth.py
+# Token-bucket bandwidth governor for firmware uploads.
+# Every chunk written to an AP first draws tokens from the bucket of the AP's
+# subnet (one site's backhaul, /24 by default) and from a global bucket (the
+# controller's uplink). A transfer that outruns its bucket sleeps just long
+# enough to stay within the rate, so forty uploads into one site share its
+# uplink evenly instead of all collapsing into timeouts.
+#
+# Buckets hand out tokens in advance and let the balance go negative, then
+# make the caller wait off the debt, so concurrent uploads are served in the
+# order they asked. Limits apply within one tool run.
+
+import ipaddress
+import threading
+import time
+
+BURST_SECONDS = 0.05
+SUBNET_PREFIX = 24
+# Smallest burst: two SFTP write chunks.
+MIN_BURST = 65536
+
+
+def mbps_to_bytes(mbps):
+    return mbps * 1e6 / 8
+
+
+class TokenBucket:
+    """Thread-safe token bucket of rate bytes per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.first = None
+        self.last = None
+
+    def reserve(self, nbytes):
+        """Take nbytes of tokens; return the seconds to wait before sending them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            self.sent += nbytes
+            if self.first is None:
+                self.first = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.last = now + wait
+            return wait
+
+    def achieved(self):
+        """Return the average rate actually used, in bytes per second, or None if all of it fit in the burst.
+
+        The initial burst goes out without waiting, so it is left out; a
+        small transfer would otherwise look far faster than the limit.
+        """
+        if self.first is None or self.sent <= self.burst or self.last <= self.first:
+            return None
+        return (self.sent - self.burst) / (self.last - self.first)
+
+
+def _usage(bucket, mbps):
+    achieved = bucket.achieved()
+    if achieved is None:
+        return f"all sent within the burst allowance, {mbps:g} Mbit/s allowed"
+    return f"{achieved * 8 / 1e6:.1f} of {mbps:g} Mbit/s allowed"
+
+
+class BandwidthGovernor:
+    """Per-subnet and global upload rate limits, in Mbit/s (None for no limit)."""
+
+    def __init__(self, global_mbps=None, subnet_mbps=None, prefix=SUBNET_PREFIX):
+        self.global_mbps = global_mbps
+        self.subnet_mbps = subnet_mbps
+        self.prefix = prefix
+        self._global = self._bucket(global_mbps)
+        self._subnets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bucket(mbps):
+        if not mbps:
+            return None
+        rate = mbps_to_bytes(mbps)
+        return TokenBucket(rate, max(MIN_BURST, rate * BURST_SECONDS))
+
+    def subnet(self, host):
+        """Return the subnet the host's uploads are accounted to."""
+        return ipaddress.ip_network(f"{host}/{self.prefix}", strict=False)
+
+    def _subnet_bucket(self, host):
+        if not self.subnet_mbps:
+            return None
+        subnet = self.subnet(host)
+        with self._lock:
+            if subnet not in self._subnets:
+                self._subnets[subnet] = self._bucket(self.subnet_mbps)
+            return self._subnets[subnet]
+
+    def throttle(self, host, nbytes):
+        """Wait until nbytes may be sent to the host within every applicable limit."""
+        wait = 0.0
+        for bucket in (self._subnet_bucket(host), self._global):
+            if bucket is not None:
+                wait = max(wait, bucket.reserve(nbytes))
+        if wait > 0:
+            time.sleep(wait)
+
+    @property
+    def enabled(self):
+        return bool(self.global_mbps or self.subnet_mbps)
+
+    def report(self):
+        """Return lines comparing achieved with allowed throughput."""
+        lines = []
+        if self._global is not None:
+            lines.append(f"All uploads: {_usage(self._global, self.global_mbps)}")
+        for subnet, bucket in sorted(self._subnets.items()):
+            lines.append(f"{subnet}: {_usage(bucket, self.subnet_mbps)}, {bucket.sent} bytes")
+        return lines
+
+
+def add_bandwidth_args(parser):
+    """Add the upload bandwidth options."""
+    group = parser.add_argument_group('bandwidth')
+    group.add_argument('--max-mbps', type=float, metavar='MBPS',
+                       help='Total upload rate limit across all APs, in Mbit/s (default: no limit).')
+    group.add_argument('--subnet-mbps', type=float, metavar='MBPS',
+                       help='Upload rate limit per subnet (site backhaul), in Mbit/s (default: no limit).')
+    group.add_argument('--subnet-prefix', type=int, default=SUBNET_PREFIX, metavar='BITS',
+                       help=f'Prefix length that groups APs into subnets for --subnet-mbps (default: {SUBNET_PREFIX}).')
+
+
+def governor_from_args(args):
+    """Build the BandwidthGovernor described by the add_bandwidth_args options."""
+    return BandwidthGovernor(args.max_mbps, args.subnet_mbps, args.subnet_prefix)
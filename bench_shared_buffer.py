@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# bench_shared_buffer.py
+# Controller memory and CPU for many concurrent uploads of one artifact.
+# Compares every transfer reading the artifact from disk itself ('read',
+# what one scp or uploader per AP does) with every transfer slicing the one
+# shared read-only mapping from artifacts.shared_buffer ('shared').
+#
+# Each transfer is a thread that walks the artifact in sftp_upload.CHUNK_SIZE
+# pieces and feeds each to zlib.crc32, which stands in for the SSH cipher
+# by reading every byte without copying it; all transfers start together and
+# stay open until the last one is done, so they really are concurrent. Each
+# mode and transfer count runs in a fresh process, so one run's peak RSS
+# does not hide the next. Peak RSS is split into anonymous memory (private
+# copies of the data) and file-backed pages (the mapping, shared with the
+# page cache and counted once however many transfers use it).
+#
+#   python bench_shared_buffer.py V5.0.13-1.dist
+#   python bench_shared_buffer.py V5.0.13-1.dist --transfers 40 200
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from artifacts import shared_buffer
+from sftp_upload import CHUNK_SIZE
+
+MODES = ('read', 'shared')
+TRANSFERS = (40, 200, 1000)
+
+
+SAMPLE_INTERVAL = 0.01
+
+
+def _rss_kib():
+    """Return (anonymous, file-backed) resident memory of this process in KiB."""
+    fields = {}
+    with open('/proc/self/status') as status:
+        for line in status:
+            name, _, value = line.partition(':')
+            if name in ('RssAnon', 'RssFile'):
+                fields[name] = int(value.split()[0])
+    return fields.get('RssAnon', 0), fields.get('RssFile', 0)
+
+
+def _read_transfer(path, start, done):
+    with open(path, 'rb') as file:
+        start.wait()
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            zlib.crc32(chunk)
+        done.wait()
+
+
+def _shared_transfer(path, start, done):
+    buffer = shared_buffer(path)
+    start.wait()
+    for position in range(0, len(buffer), CHUNK_SIZE):
+        zlib.crc32(buffer[position:position + CHUNK_SIZE])
+    done.wait()
+
+
+def run_worker(path, mode, count):
+    """Run count concurrent transfers in this process and return its measurements."""
+    transfer = _read_transfer if mode == 'read' else _shared_transfer
+    start = threading.Barrier(count + 1)
+    done = threading.Barrier(count)
+    threads = [threading.Thread(target=transfer, args=(path, start, done)) for _ in range(count)]
+    anon_baseline, file_baseline = _rss_kib()
+    peak_anon, peak_file = anon_baseline, file_baseline
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    for thread in threads:
+        thread.start()
+    started = time.monotonic()
+    start.wait()
+    while any(thread.is_alive() for thread in threads):
+        anon, file = _rss_kib()
+        peak_anon, peak_file = max(peak_anon, anon), max(peak_file, file)
+        time.sleep(SAMPLE_INTERVAL)
+    wall = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'mode': mode,
+        'transfers': count,
+        'anon_growth_mib': (peak_anon - anon_baseline) / 1024,
+        'file_growth_mib': (peak_file - file_baseline) / 1024,
+        'peak_rss_mib': after.ru_maxrss / 1024,
+        'cpu_seconds': (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        'wall_seconds': wall,
+    }
+
+
+def main(path, counts, modes):
+    size = os.path.getsize(path)
+    print(f"{os.path.basename(path)}: {size} bytes, {CHUNK_SIZE}-byte chunks")
+    print(f"{'mode':<8} {'transfers':>9} {'anon MiB':>9} {'file MiB':>9} {'peak RSS MiB':>13} "
+          f"{'CPU s':>8} {'wall s':>8}")
+    for count in counts:
+        for mode in modes:
+            output = subprocess.run([sys.executable, __file__, path, '--worker', mode, '--transfers', str(count)],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            print(f"{mode:<8} {count:>9} {result['anon_growth_mib']:>9.1f} {result['file_growth_mib']:>9.1f} "
+                  f"{result['peak_rss_mib']:>13.1f} {result['cpu_seconds']:>8.2f} {result['wall_seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark controller RSS and CPU for concurrent artifact uploads.')
+    parser.add_argument('artifact', help='Artifact to send, e.g. the .dist firmware image.')
+    parser.add_argument('--transfers', type=int, nargs='+', default=list(TRANSFERS),
+                        help='Concurrent transfer counts to measure (default: 40 200 1000).')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES),
+                        help='Read modes to compare (default: both).')
+    parser.add_argument('--worker', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.artifact):
+        print(f"Error: The file {args.artifact} was not found.")
+        sys.exit(1)
+    if args.worker:
+        print(json.dumps(run_worker(args.artifact, args.worker, args.transfers[0])))
+    else:
+        main(args.artifact, args.transfers, args.modes)
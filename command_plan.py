@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# command_plan.py
+# Batch a per-host list of commands into a single shell invocation on the AP.
+# The whole plan is shipped to 'sh -s' in one exec request and the AP answers
+# with one record per step (exit status, start/end time, stdout, stderr), so a
+# multi-step job costs one round trip instead of one per command.
+#
+# Record format, one per step that ran:
+#   <marker> <name> <exit_status> <start> <end> <stdout_bytes> <stderr_bytes>\n
+#   <stdout bytes><stderr bytes>
+# start/end come from /proc/uptime (centisecond resolution) on the AP. Each
+# step runs in a subshell, so an 'exit' or a 'set -e' failure in one step
+# only ends that step and is reported as its exit status. Steps are never run
+# inside a '||' list, where the shell would ignore 'set -e'.
+
+import re
+import shlex
+import uuid
+from collections import namedtuple
+
+from remote_cmd import run_command
+
+PLAN_TIMEOUT = 120
+
+PlanStep = namedtuple('PlanStep', ['name', 'command', 'stop_on_error'])
+StepResult = namedtuple('StepResult', ['name', 'exit_status', 'duration', 'stdout', 'stderr'])
+
+_STEP_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+_PRELUDE = '''\
+T=/tmp/.plan.$$
+trap 'rm -f $T.o $T.e' EXIT
+now() {
+    if [ -r /proc/uptime ]; then read up rest < /proc/uptime; echo $up; else date +%s; fi
+}
+step() {
+    s=$(now)
+    ( eval "$2" ) > $T.o 2> $T.e < /dev/null
+    rc=$?
+    e=$(now)
+    echo "$M $1 $rc $s $e $(wc -c < $T.o) $(wc -c < $T.e)"
+    cat $T.o $T.e
+    return $rc
+}
+'''
+
+
+class CommandPlan:
+    """An ordered list of commands to run on an AP in one round trip."""
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+        self.steps = []
+
+    def add(self, name, command, stop_on_error=True):
+        """Append a step; a failing step ends the plan unless stop_on_error is False."""
+        if not _STEP_NAME.match(name):
+            raise ValueError(f"Invalid plan step name: {name!r}")
+        if any(step.name == name for step in self.steps):
+            raise ValueError(f"Duplicate plan step name: {name!r}")
+        self.steps.append(PlanStep(name, command, stop_on_error))
+        return self
+
+    def render(self, marker):
+        """Return the shell script that runs every step and prints its records."""
+        lines = [f"M={marker}", _PRELUDE]
+        if self.cwd:
+            lines.append(f"cd {shlex.quote(self.cwd)} || exit 1")
+        for step in self.steps:
+            lines.append(f"step {step.name} {shlex.quote(step.command)}")
+            if step.stop_on_error:
+                # Checked on its own line: 'step ... || exit 0' would disable set -e in the step.
+                lines.append("[ $? -eq 0 ] || exit 0")
+        return '\n'.join(lines) + '\n'
+
+    def run(self, client, timeout=PLAN_TIMEOUT):
+        """Run the plan on a connected client and return a PlanResult."""
+        marker = f"@@plan-{uuid.uuid4().hex}"
+        result = run_command(client, 'sh -s', timeout=timeout,
+                             stdin=self.render(marker).encode('utf-8'), encoding=None)
+        return PlanResult(self.steps, _parse_records(result.stdout, marker), result.stderr.decode('utf-8', 'replace'))
+
+
+class PlanResult:
+    """Per-step results of a CommandPlan run; steps that never ran have exit_status None."""
+
+    def __init__(self, steps, records, stderr=''):
+        self.stderr = stderr
+        self.steps = [records.get(step.name, StepResult(step.name, None, None, '', '')) for step in steps]
+
+    def __getitem__(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    @property
+    def ok(self):
+        """True if every step ran and exited 0."""
+        return all(step.exit_status == 0 for step in self.steps)
+
+    @property
+    def failed(self):
+        """The first step that ran and failed, or None."""
+        for step in self.steps:
+            if step.exit_status not in (0, None):
+                return step
+        return None
+
+
+def _parse_records(data, marker):
+    """Split the raw plan output into StepResults keyed by step name."""
+    records = {}
+    header = marker.encode('ascii') + b' '
+    pos = data.find(header)
+    while pos != -1:
+        end = data.find(b'\n', pos)
+        if end == -1:
+            break
+        fields = data[pos + len(header):end].decode('ascii', 'replace').split()
+        try:
+            name, rc, start, finish, out_len, err_len = fields
+            rc, out_len, err_len = int(rc), int(out_len), int(err_len)
+            duration = round(max(float(finish) - float(start), 0.0), 2)
+        except ValueError:
+            break
+        body = end + 1
+        stdout = data[body:body + out_len].decode('utf-8', 'replace')
+        stderr = data[body + out_len:body + out_len + err_len].decode('utf-8', 'replace')
+        records[name] = StepResult(name, rc, duration, stdout, stderr)
+        pos = data.find(header, body + out_len + err_len)
+    return records
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# fanout.py
+# Tree fan-out distribution of the firmware within each subnet.
+# The controller uploads the files once per subnet, to a seed AP. Every AP
+# that holds verified copies then forwards them over the LAN to up to WIDTH
+# neighbours, which forward them in turn, down to DEPTH hops below the seed.
+# A /24 of 200+ APs thus costs one WAN transfer instead of 200.
+#
+# Each hop runs the relay command on the sending AP (by default dropbear's
+# dbclient streaming the file into '<name>.part' on the receiving AP, with
+# the SSH password read from stdin rather than put on a command line), then
+# checks the digest of the .part on the receiving AP against the local
+# artifact before renaming it into place. An AP whose parent has no verified
+# copies, or whose relay fails, gets a direct upload from the controller.
+
+import asyncio
+import collections
+import ipaddress
+import os
+import shlex
+import time
+
+from artifacts import file_digest, remote_digests
+from bandwidth import SUBNET_PREFIX
+from remote_cmd import run_command
+from sftp_upload import Transfer, finish_parts, staging_paths, throughput
+
+DEPTH = 3
+WIDTH = 8
+RELAY_TIMEOUT = 600
+
+# Placeholders: {user}, {target} (receiving AP), {source} (path on the
+# sending AP), {part} (path on the receiving AP) and {write} (the remote
+# command that writes stdin to {part}). Paths are already shell-quoted.
+RELAY_COMMAND = ('read -r DROPBEAR_PASSWORD && export DROPBEAR_PASSWORD && '
+                 'dbclient -y -y -l {user} {target} {write} < {source}')
+
+
+class RelayError(Exception):
+    """Raised when files cannot be relayed from one AP to another."""
+
+
+def plan_fanout(hosts, prefix=SUBNET_PREFIX, depth=DEPTH, width=WIDTH):
+    """Return {host: parent AP it receives the files from}.
+
+    The first host of each subnet is its seed; the rest are handed out
+    breadth first, width per parent, down to depth hops. Seeds, hosts beyond
+    the tree and hosts that are not IP addresses have no parent (None) and
+    are uploaded to directly.
+    """
+    parents = {}
+    subnets = {}
+    for host in hosts:
+        try:
+            subnet = ipaddress.ip_network(f"{host}/{prefix}", strict=False)
+        except ValueError:
+            parents[host] = None
+            continue
+        subnets.setdefault(subnet, []).append(host)
+    for members in subnets.values():
+        parents[members[0]] = None
+        rest = collections.deque(members[1:])
+        layer = [members[0]]
+        for _ in range(depth):
+            next_layer = []
+            for parent in layer:
+                for _ in range(min(width, len(rest))):
+                    child = rest.popleft()
+                    parents[child] = parent
+                    next_layer.append(child)
+            layer = next_layer
+        parents.update(dict.fromkeys(rest))
+    return parents
+
+
+def relay_files(source_client, target_client, target, file_paths, destination, password, algorithm='sha256',
+                command=RELAY_COMMAND, username='root', timeout=None, relay_timeout=RELAY_TIMEOUT):
+    """Copy the files from the destination on the source AP to the same place on the target AP.
+
+    Files the target already holds with the right digest are left alone.
+    Returns a Transfer per file, in the order given (sent is 0 for files
+    already present). Raises RelayError if the relay command fails or the
+    target cannot compute digests, ChecksumMismatch if a relayed copy
+    differs from the local artifact and IOError if it cannot be renamed.
+    """
+    remote_paths, part_paths = staging_paths(file_paths, destination)
+    local = {path: file_digest(path, algorithm) for path in file_paths}
+
+    present = remote_digests(target_client, list(remote_paths.values()), algorithm, timeout)
+    if present is None:
+        raise RelayError(f"no {algorithm}sum on {target} to verify relayed copies")
+    missing = [path for path in file_paths if present.get(remote_paths[path]) != local[path]]
+
+    relayed = {}
+    for path in missing:
+        part = shlex.quote(part_paths[path])
+        started = time.monotonic()
+        result = run_command(source_client,
+                             command.format(user=username, target=target, source=shlex.quote(remote_paths[path]),
+                                            part=part, write=shlex.quote(f"cat > {part}")),
+                             timeout=relay_timeout, stdin=f"{password}\n")
+        if result.exit_status != 0:
+            raise RelayError(f"relay of {remote_paths[path]} exited with status {result.exit_status}: "
+                             f"{result.stderr.strip()}")
+        size = os.path.getsize(path)
+        relayed[path] = Transfer(path, remote_paths[path], size, time.monotonic() - started, size)
+
+    finish_parts(target_client, missing, destination, algorithm, timeout, how='relay')
+
+    return [relayed.get(path) or Transfer(path, remote_paths[path], os.path.getsize(path), 0.0, 0)
+            for path in file_paths]
+
+
+def relay_from(host, parent, pool, file_paths, destination, algorithm, command, timeouts):
+    """Relay the files to the host from its parent AP over their pooled connections."""
+    transfers = relay_files(pool.get(parent, timeout=timeouts.login), pool.get(host, timeout=timeouts.login), host,
+                            file_paths, destination, pool.password, algorithm, command, pool.username,
+                            timeouts.command)
+    for transfer in transfers:
+        name = os.path.basename(transfer.local_path)
+        if not transfer.sent:
+            print(f"{host}: {name} already present.")
+            continue
+        print(f"{host}: {name} relayed from {parent}, {transfer.sent} bytes in {transfer.seconds:.2f}s "
+              f"({throughput(transfer):.1f} Mbit/s)")
+
+
+class Fanout:
+    """The fan-out tree of one copy run and how far the files have got down it."""
+
+    def __init__(self, depth=DEPTH, width=WIDTH, prefix=SUBNET_PREFIX, command=RELAY_COMMAND):
+        self.depth = depth
+        self.width = width
+        self.prefix = prefix
+        self.command = command
+        self.parents = {}
+        self.relayed = 0
+        self.fallbacks = 0
+        self._children = collections.Counter()
+        self._released = set()
+        self._ready = {}
+
+    def plan(self, hosts):
+        """Lay out the tree over the hosts, which must be the whole run's inventory."""
+        self.parents = plan_fanout(hosts, self.prefix, self.depth, self.width)
+        self._children = collections.Counter(parent for parent in self.parents.values() if parent is not None)
+
+    def _future(self, host):
+        if host not in self._ready:
+            self._ready[host] = asyncio.get_running_loop().create_future()
+        return self._ready[host]
+
+    def _release(self, host, pool):
+        """Count the host off its parent, closing the parent's connection after its last child."""
+        parent = self.parents.get(host)
+        if parent is None or host in self._released:
+            return
+        self._released.add(host)
+        self._children[parent] -= 1
+        if not self._children[parent] and self._future(parent).done():
+            pool.close(parent)
+
+    def finished(self, host, verified, pool):
+        """Record whether the host ended up with verified copies its children can relay.
+
+        The host's pooled connection is closed, or left open for its
+        children and closed once the last of them is done. A host that
+        never relayed (unreachable, say) is counted off its parent here.
+        """
+        future = self._future(host)
+        if not future.done():
+            future.set_result(verified)
+        if not self._children[host]:
+            pool.close(host)
+        self._release(host, pool)
+
+    async def relay(self, host, fleet, pool, file_paths, destination, algorithm):
+        """Relay the files to the host from its parent AP.
+
+        Returns True once the host holds verified copies, or False if it has
+        no parent or the relay failed and the files must be uploaded directly.
+        """
+        parent = self.parents.get(host)
+        if parent is None:
+            return False
+        try:
+            if not await self._future(parent):
+                print(f"{host}: {parent} has no verified copies to relay, uploading directly.")
+                self.fallbacks += 1
+                return False
+            await fleet.run_on_host(host, relay_from, parent, pool, file_paths, destination, algorithm,
+                                    self.command, fleet.timeouts(host), exclusive=True)
+            self.relayed += 1
+            return True
+        except Exception as e:
+            print(f"{host}: relay from {parent} failed ({e}), uploading directly.")
+            self.fallbacks += 1
+            return False
+        finally:
+            self._release(host, pool)
+
+    def report(self):
+        """Return lines summarising how the files were distributed."""
+        seeds = sum(1 for parent in self.parents.values() if parent is None)
+        return [f"{seeds} APs uploaded to directly as seeds or outside the tree",
+                f"{self.relayed} APs relayed from a neighbour, {self.fallbacks} fell back to a direct upload"]
+
+
+def add_fanout_args(parser):
+    """Add the fan-out distribution options."""
+    group = parser.add_argument_group('fan-out')
+    group.add_argument('--fanout', action='store_true',
+                       help='Upload once per subnet (see --subnet-prefix) and let the APs relay the files '
+                            'to their neighbours.')
+    group.add_argument('--fanout-depth', type=int, default=DEPTH, metavar='HOPS',
+                       help=f'AP-to-AP hops below each seed AP (default: {DEPTH}).')
+    group.add_argument('--fanout-width', type=int, default=WIDTH, metavar='APS',
+                       help=f'Neighbours each AP relays the files to (default: {WIDTH}).')
+    group.add_argument('--relay-command', default=RELAY_COMMAND, metavar='TEMPLATE',
+                       help='Command run on the sending AP to copy one file to a neighbour, with the SSH password '
+                            'on stdin; placeholders {user}, {target}, {source}, {part} and {write} '
+                            '(default: dropbear dbclient).')
+
+
+def fanout_from_args(args):
+    """Build the Fanout described by the add_fanout_args options, or None without --fanout."""
+    if not args.fanout:
+        return None
+    return Fanout(args.fanout_depth, args.fanout_width, args.subnet_prefix, args.relay_command)
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# fleet.py
+# asyncio orchestration core shared by the CCS3 AP tools.
+# Every host gets its own coroutine, so a whole inventory is in flight at
+# once; what actually runs concurrently is bounded per operation type by a
+# semaphore (e.g. 'ping', 'ssh'). Blocking paramiko work is handed to a
+# thread pool sized to the 'ssh' limit, so threads are only spent on hosts
+# that are really talking SSH, never on hosts waiting for a ping.
+#
+# Reachability is decided up front by one in-process ICMP sweep over the
+# whole inventory (icmp_sweep.py), which re-sends to silent hosts for up to
+# ping_attempts passes. Hosts the sweep could not cover, or every host when
+# no ICMP socket can be opened, fall back to a per-host ping of as many
+# echoes.
+#
+# With reach='ssh' there is no ICMP at all: a host is reachable when a
+# non-blocking connect to port 22 succeeds and the peer sends an SSH banner.
+# The connected socket is kept and handed to the connection pool (see
+# take_socket / SSHPool sock_source), so the probe doubles as the SSH
+# connection instead of being a separate round trip.
+#
+# Results of every probe are also written to the shared on-disk
+# reachability cache (reach_cache.py); a host with a fresh cache entry is
+# not probed again, so back-to-back tool runs skip straight to SSH. Down
+# entries stay fresh for much less time than up ones.
+#
+# The RTTs gathered this way also tune the run: each host gets login and
+# command timeouts scaled to its own link (timeouts()), and hosts are
+# dispatched slowest-first so the long tail starts early instead of last.
+#
+# Hosts are consumed lazily in batches of DISPATCH_BATCH: each batch is
+# swept, ordered and dispatched before the next one is read, so a large
+# inventory starts working before it has been fully parsed. Latency
+# ordering is therefore per batch.
+#
+# Each host's outcome is written to a reason-coded results CSV (results.py).
+# process_host fails a host by raising HostFailure(reason, phase); any
+# other exception fails just that host, in phase 'tool'. The time
+# a host spends holding a concurrency slot (probing, SSH work) is charged to
+# it, so the elapsed column shows work done, not time queued.
+#
+# With a shared work queue (work_queue.py) the inventory is only used to
+# fill the queue; hosts are then leased a window at a time, as many as there
+# are SSH slots free, and leases are renewed by a heartbeat task until the
+# host is finished.
+#
+# SSH work on an AP goes through run_on_host, which also takes the AP's
+# cross-tool lock (exclusive for tools that change the AP, shared for
+# audits) and a slot of the controller-wide SSH budget (host_locks.py).
+# Audits back off from an AP another tool holds exclusively; changing tools
+# wait up to lock_wait seconds for it.
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import itertools
+import math
+import os
+import platform
+import socket
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import icmp_sweep
+from host_locks import EXCLUSIVE, SHARED, SSH_SLOTS, HostLocks
+from reach_cache import CACHE_DOWN_TTL, CACHE_TTL, ReachabilityCache
+from remote_cmd import COMMAND_TIMEOUT
+from results import BUSY, LOCK, TOOL, HostFailure, ResultsWriter, default_results_path, failure
+from work_queue import POLL_INTERVAL, WorkQueue
+from ssh_pool import CONNECT_TIMEOUT as LOGIN_TIMEOUT, SSH_PORT
+from ssh_profiles import add_profile_args, profile_from_args
+
+DEFAULT_LIMITS = {
+    'ping': 256,
+    'ssh': 40,
+}
+PING_TIMEOUT = icmp_sweep.SWEEP_TIMEOUT
+PING_ATTEMPTS = icmp_sweep.SWEEP_ATTEMPTS
+DISPATCH_BATCH = 512
+CONNECT_TIMEOUT = 5.0
+REACH_MODES = ('icmp', 'ssh')
+LOCK_WAIT = 60.0
+LOCK_POLL = 0.25
+
+# Per-host timeout = base + factor * RTT, clamped to the maximum. The base
+# covers AP-side work (key exchange on the AP6 CPU, web_ctrl); the factor
+# covers the round trips a login or command needs on the AP's link.
+LOGIN_TIMEOUT_BASE = 15.0
+LOGIN_TIMEOUT_PER_RTT = 20
+LOGIN_TIMEOUT_MAX = 120.0
+COMMAND_TIMEOUT_BASE = 20.0
+COMMAND_TIMEOUT_PER_RTT = 10
+COMMAND_TIMEOUT_MAX = 300.0
+
+HostTimeouts = namedtuple('HostTimeouts', ['login', 'command'])
+DEFAULT_TIMEOUTS = HostTimeouts(LOGIN_TIMEOUT, COMMAND_TIMEOUT)
+
+# Seconds of work charged to the host whose task is running, as a 1-item list.
+_busy_time = contextvars.ContextVar('busy_time', default=None)
+
+
+class Fleet:
+    """Run a coroutine per host with a concurrency limit per operation type."""
+
+    def __init__(self, limits=None, ping_timeout=PING_TIMEOUT, ping_attempts=PING_ATTEMPTS, use_sweep=True,
+                 reach='icmp', connect_timeout=CONNECT_TIMEOUT, cache=None, adaptive=True, results=None,
+                 queue=None, locks=None, lock_wait=LOCK_WAIT, ssh_profile=None):
+        if reach not in REACH_MODES:
+            raise ValueError(f"Unknown reachability mode: {reach}")
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.ping_timeout = ping_timeout
+        self.ping_attempts = ping_attempts
+        self.use_sweep = use_sweep
+        self.reach = reach
+        self.connect_timeout = connect_timeout
+        self.cache = cache
+        self.adaptive = adaptive
+        self.results = results
+        self.queue = queue
+        self.locks = locks
+        self.lock_wait = lock_wait
+        # SSHProfile for the tool's SSHPool (None: paramiko's defaults).
+        self.ssh_profile = ssh_profile
+        self.rtt = {}
+        # Hand sockets probed by reach='ssh' on to the pool (see take_socket).
+        self.keep_probe_sockets = True
+        self._sockets = {}
+        self._semaphores = {}
+        self._executor = None
+
+    def limit(self, kind):
+        """Return the semaphore bounding operations of the given kind."""
+        if kind not in self._semaphores:
+            self._semaphores[kind] = asyncio.BoundedSemaphore(self.limits[kind])
+        return self._semaphores[kind]
+
+    @contextlib.asynccontextmanager
+    async def charged(self):
+        """Charge the time spent in the block to the current host."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            spent = _busy_time.get()
+            if spent is not None:
+                spent[0] += time.monotonic() - started
+
+    @contextlib.asynccontextmanager
+    async def busy(self, kind):
+        """Hold a slot of the kind's limit and charge the time spent to the current host."""
+        async with self.limit(kind), self.charged():
+            yield
+
+    async def run_in_thread(self, kind, func, *args):
+        """Run a blocking call in the worker pool under the kind's limit."""
+        async with self.busy(kind):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    @contextlib.asynccontextmanager
+    async def host_lock(self, host, exclusive=False):
+        """Hold the host's cross-tool lock; raises HostFailure(BUSY) if it cannot be had.
+
+        A shared lock is given up at once if another tool holds the host
+        exclusively; an exclusive lock is waited for up to lock_wait seconds.
+        """
+        if self.locks is None:
+            yield
+            return
+        mode = EXCLUSIVE if exclusive else SHARED
+        deadline = time.monotonic() + self.lock_wait
+        while True:
+            fd = self.locks.try_host(host, mode)
+            if fd is not None:
+                break
+            if not exclusive or time.monotonic() >= deadline:
+                holder = self.locks.holder(host)
+                print(f"Backing off from {host}: in use by {holder or 'another tool'}.")
+                raise HostFailure(BUSY, LOCK, f"in use by {holder or 'another tool'}")
+            await asyncio.sleep(LOCK_POLL)
+        try:
+            yield
+        finally:
+            self.locks.release_host(fd)
+
+    @contextlib.asynccontextmanager
+    async def ssh_slot(self):
+        """Hold one slot of the SSH session budget shared by every tool on the controller."""
+        if self.locks is None or not self.locks.ssh_slots:
+            yield
+            return
+        while True:
+            index = self.locks.try_slot()
+            if index is not None:
+                break
+            await asyncio.sleep(LOCK_POLL)
+        try:
+            yield
+        finally:
+            self.locks.release_slot(index)
+
+    async def run_on_host(self, host, func, *args, exclusive=False, lock=True):
+        """Run func(host, *args) in the worker pool as SSH work on the host.
+
+        The call holds an 'ssh' slot, the host's cross-tool lock (exclusive
+        for work that changes the AP) and a slot of the global SSH budget.
+        With lock=False the caller already holds the host's lock itself.
+        Only the time after all three are held is charged to the host.
+        """
+        async with self.limit('ssh'):
+            async with (self.host_lock(host, exclusive) if lock else contextlib.nullcontext()):
+                async with self.ssh_slot(), self.charged():
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self._executor, functools.partial(func, host, *args))
+
+    async def sweep(self, hosts):
+        """Ping all hosts from one ICMP socket and remember who answered."""
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(None, icmp_sweep.sweep, hosts, self.ping_timeout,
+                                                 self.ping_attempts)
+        except OSError as e:
+            print(f"ICMP sweep unavailable ({e}), falling back to per-host ping.")
+            return
+        self.rtt.update(results)
+        if self.cache is not None:
+            for host, rtt in results.items():
+                self.cache.record(host, rtt is not None, rtt)
+
+    async def _wait_readable(self, sock):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(sock.fileno())
+
+    async def _connect_ssh(self, sock, host):
+        loop = asyncio.get_running_loop()
+        await loop.sock_connect(sock, (host, SSH_PORT))
+        await self._wait_readable(sock)
+        # Peek so the banner is still there for the SSH transport to read.
+        return sock.recv(256, socket.MSG_PEEK).startswith(b'SSH-')
+
+    async def probe_ssh(self, host):
+        """Connect to the host's SSH port and check for a banner; True if sshd answered."""
+        async with self.busy('ping'):
+            loop = asyncio.get_running_loop()
+            try:
+                address = (await loop.getaddrinfo(host, SSH_PORT, family=socket.AF_INET,
+                                                  type=socket.SOCK_STREAM))[0][4][0]
+            except OSError:
+                return False
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            started = loop.time()
+            try:
+                ok = await asyncio.wait_for(self._connect_ssh(sock, address), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError):
+                ok = False
+            if not ok:
+                sock.close()
+                return False
+            self.rtt[host] = loop.time() - started
+            # Only keep as many idle sockets as can soon be used; the rest
+            # are closed and the pool simply reconnects.
+            if self.keep_probe_sockets and len(self._sockets) < self.limits['ssh'] * 2:
+                sock.setblocking(True)
+                self._sockets[host] = sock
+            else:
+                sock.close()
+            return True
+
+    def take_socket(self, host):
+        """Hand over the connected socket left by probe_ssh, if any."""
+        return self._sockets.pop(host, None)
+
+    def cached(self, host):
+        """Return (up, rtt) from the reachability cache, or None if not fresh."""
+        if self.cache is None:
+            return None
+        return self.cache.lookup(host)
+
+    async def ping(self, host):
+        """Return True if the host answered the sweep or, without one, a per-host ping.
+
+        A fresh reachability cache entry is used without probing. In 'ssh'
+        reach mode the SSH port probe is used instead of ICMP.
+        """
+        cached = self.cached(host)
+        if cached is not None:
+            up, rtt = cached
+            if up and rtt is not None:
+                self.rtt.setdefault(host, rtt)
+            return up
+        if self.reach == 'ssh':
+            up = await self.probe_ssh(host)
+        elif host in self.rtt:
+            return self.rtt[host] is not None
+        else:
+            up = await self._ping_once(host)
+        if self.cache is not None:
+            self.cache.record(host, up, self.rtt.get(host) if up else None)
+        return up
+
+    def timeouts(self, host):
+        """Return HostTimeouts for the host, scaled to its measured RTT."""
+        rtt = self.rtt.get(host)
+        if not self.adaptive or rtt is None:
+            return DEFAULT_TIMEOUTS
+        return HostTimeouts(
+            min(LOGIN_TIMEOUT_BASE + LOGIN_TIMEOUT_PER_RTT * rtt, LOGIN_TIMEOUT_MAX),
+            min(COMMAND_TIMEOUT_BASE + COMMAND_TIMEOUT_PER_RTT * rtt, COMMAND_TIMEOUT_MAX),
+        )
+
+    def by_latency(self, hosts):
+        """Order hosts slowest link first; hosts without an RTT keep their order at the end."""
+        return sorted(hosts, key=lambda host: -(self.rtt.get(host) or 0.0))
+
+    async def _ping_once(self, host):
+        if platform.system().lower() == 'windows':
+            wait_args = ['-n', str(self.ping_attempts), '-w', str(int(self.ping_timeout * 1000))]
+        else:
+            # Exits 0 if any of the echoes is answered.
+            wait_args = ['-c', str(self.ping_attempts), '-W', str(max(1, math.ceil(self.ping_timeout)))]
+        async with self.busy('ping'):
+            proc = await asyncio.create_subprocess_exec(
+                'ping', *wait_args, host,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            return await proc.wait() == 0
+
+    async def _prepare(self, batch):
+        """Probe and order one batch of hosts before it is dispatched."""
+        if self.use_sweep and self.reach == 'icmp':
+            await self.sweep([host for host in batch if self.cached(host) is None])
+        if self.adaptive:
+            for host in batch:
+                cached = self.cached(host)
+                if cached is not None and cached[1] is not None:
+                    self.rtt.setdefault(host, cached[1])
+            batch = self.by_latency(batch)
+        return batch
+
+    async def _process(self, host, process_host, args):
+        """Run process_host for one host and record its reason-coded result."""
+        spent = [0.0]
+        _busy_time.set(spent)
+        reason = phase = detail = ''
+        try:
+            host, status = await process_host(host, self, *args)
+        except HostFailure as e:
+            status, reason, phase, detail = 'bad', e.reason, e.phase, e.detail
+        except Exception as e:
+            # One host's unexpected error (state store, lock files, ping) must not end the run.
+            print(f"Error processing {host}: {e}")
+            e = failure(e, TOOL)
+            status, reason, phase, detail = 'bad', e.reason, e.phase, e.detail
+        if self.results is not None:
+            self.results.write(host, status, reason, phase, spent[0], detail)
+        return host, status
+
+    async def _dispatch(self, hosts, process_host, args):
+        """Dispatch every host of the inventory and yield (host, status) as they finish."""
+        hosts = iter(hosts)
+        tasks = []
+        for batch in iter(lambda: list(itertools.islice(hosts, DISPATCH_BATCH)), []):
+            for host in await self._prepare(batch):
+                tasks.append(asyncio.ensure_future(self._process(host, process_host, args)))
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.queue.lease_time / 3)
+            await loop.run_in_executor(None, self.queue.heartbeat)
+
+    async def _drain(self, process_host, args):
+        """Lease hosts from the work queue as SSH slots free up and yield (host, status) as they finish."""
+        loop = asyncio.get_running_loop()
+        window = self.limits['ssh']
+        running = set()
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, self.queue.lease, window - len(running))
+                for host in await self._prepare(batch):
+                    running.add(asyncio.ensure_future(self._process(host, process_host, args)))
+                if not running:
+                    # Hosts leased by other processes come back if their lease expires.
+                    if not await loop.run_in_executor(None, self.queue.unfinished):
+                        return
+                    await asyncio.sleep(min(POLL_INTERVAL, self.queue.lease_time))
+                    continue
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    host, status = task.result()
+                    await loop.run_in_executor(None, self.queue.finish, host, status == 'good')
+                    yield host, status
+        finally:
+            heartbeat.cancel()
+            for task in running:
+                task.cancel()
+            self.queue.release()
+
+    async def _run(self, hosts, process_host, args):
+        good_hosts = []
+        bad_hosts = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.limits['ssh']) as executor:
+                self._executor = executor
+                if self.queue is None:
+                    outcomes = self._dispatch(hosts, process_host, args)
+                else:
+                    outcomes = self._drain(process_host, args)
+                async for host, status in outcomes:
+                    if status == 'good':
+                        good_hosts.append(host)
+                    else:
+                        bad_hosts.append(host)
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+            if self.results is not None:
+                self.results.close()
+            if self.locks is not None:
+                self.locks.close()
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets = {}
+        self._semaphores = {}
+        self._executor = None
+        return good_hosts, bad_hosts
+
+    def run(self, hosts, process_host, *args):
+        """Run process_host(host, fleet, *args) for every host.
+
+        hosts may be any iterable, including a lazy inventory stream.
+        With a work queue the hosts are added to it first and this process
+        then works on whatever it leases from the queue.
+        process_host returns (host, status) or raises HostFailure for a
+        reason-coded failure, which counts as 'bad'.
+        Returns (good_hosts, bad_hosts) like the old thread-pool loops did.
+        """
+        if self.queue is not None:
+            added = self.queue.fill(hosts)
+            print(f"Added {added} hosts to work queue job '{self.queue.job}'.")
+        return asyncio.run(self._run(hosts, process_host, args))
+
+
+def add_fleet_args(parser, ssh_workers=DEFAULT_LIMITS['ssh']):
+    """Add the concurrency options shared by the fleet tools."""
+    parser.add_argument('--max-ssh', type=int, default=ssh_workers,
+                        help=f'Maximum concurrent SSH sessions (default: {ssh_workers}).')
+    parser.add_argument('--max-ping', type=int, default=DEFAULT_LIMITS['ping'],
+                        help=f"Maximum concurrent reachability probes (default: {DEFAULT_LIMITS['ping']}).")
+    parser.add_argument('--ping-timeout', type=float, default=PING_TIMEOUT,
+                        help=f'Seconds to wait for ping replies (default: {PING_TIMEOUT}).')
+    parser.add_argument('--ping-attempts', type=int, default=PING_ATTEMPTS,
+                        help=f'Echoes sent to a host before it is taken to be down (default: {PING_ATTEMPTS}).')
+    parser.add_argument('--no-sweep', action='store_true',
+                        help='Ping hosts one at a time instead of one ICMP sweep over the inventory.')
+    parser.add_argument('--reach', choices=REACH_MODES, default='icmp',
+                        help="How to decide a host is reachable: ICMP ping, or 'ssh' to connect to "
+                             "port 22 and reuse that connection for the session (default: icmp).")
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help=f'Seconds to wait for the SSH port and banner with --reach ssh (default: {CONNECT_TIMEOUT}).')
+    parser.add_argument('--fixed-timeouts', action='store_true',
+                        help='Use fixed login/command timeouts and inventory order instead of '
+                             'deriving them from each host\'s measured RTT.')
+    parser.add_argument('--reach-ttl', type=float, default=CACHE_TTL,
+                        help=f'Seconds a cached up result is trusted; 0 disables the cache (default: {CACHE_TTL}).')
+    parser.add_argument('--reach-down-ttl', type=float, default=CACHE_DOWN_TTL,
+                        help=f'Seconds a cached down result is trusted; 0 always re-probes hosts last seen down '
+                             f'(default: {CACHE_DOWN_TTL}).')
+    parser.add_argument('--reach-cache', metavar='PATH',
+                        help='Reachability cache file (default: ~/.cache/ap_ccs3/reachability.json).')
+    parser.add_argument('--lock-dir', metavar='PATH',
+                        help='Directory of the per-AP locks and SSH slots shared by all tools on this controller '
+                             '(default: $XDG_RUNTIME_DIR/ap_ccs3 or /tmp/ap_ccs3-<uid>).')
+    parser.add_argument('--lock-wait', type=float, default=LOCK_WAIT,
+                        help=f'Seconds a tool that changes an AP waits for other tools to release it (default: {LOCK_WAIT}).')
+    parser.add_argument('--max-ssh-global', type=int, default=SSH_SLOTS,
+                        help=f'Maximum concurrent SSH sessions across all tools on this controller; 0 for no limit '
+                             f'(default: {SSH_SLOTS}).')
+    parser.add_argument('--results', metavar='PATH',
+                        help='Reason-coded results CSV to write (default: <tool>_results.csv).')
+    add_profile_args(parser)
+
+
+def fleet_from_args(args):
+    """Build a Fleet from parsed add_fleet_args options."""
+    cache = (ReachabilityCache(args.reach_cache, ttl=args.reach_ttl, down_ttl=args.reach_down_ttl)
+             if args.reach_ttl > 0 else None)
+    queue = None
+    results_path = args.results
+    if getattr(args, 'queue', None):
+        queue = WorkQueue(args.queue, args.queue_job, lease_time=args.lease)
+        # Several processes share the queue; each keeps its own results file.
+        results_path = results_path or default_results_path(os.getpid())
+    return Fleet({'ssh': args.max_ssh, 'ping': args.max_ping},
+                 ping_timeout=args.ping_timeout, ping_attempts=args.ping_attempts, use_sweep=not args.no_sweep,
+                 reach=args.reach, connect_timeout=args.connect_timeout, cache=cache,
+                 adaptive=not args.fixed_timeouts, results=ResultsWriter(results_path),
+                 queue=queue, locks=HostLocks(args.lock_dir, args.max_ssh_global), lock_wait=args.lock_wait,
+                 ssh_profile=profile_from_args(args))
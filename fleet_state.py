@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# fleet_state.py
+# Persistent per-AP state store shared by the CCS3 AP tools.
+# A local SQLite database records the last outcome of each operation for each
+# AP (firmware copied, files verified, NTP seen, upgrade launched, upgrade
+# completed) with a timestamp. Tools consult it before touching a host, so a
+# rerun over the full inventory only does the work that is still missing.
+# Outcomes older than max_age no longer count as done. State that only the
+# AP itself can vouch for (files in its /tmp, lost on reboot) is never
+# trusted from here: the copy tool checks digests on the AP and the audit
+# tool always looks.
+#
+# The database uses WAL mode and a busy timeout, so several tools can read
+# and write it at the same time.
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+COPIED = 'copied'
+FILES_VERIFIED = 'files_verified'
+NTP_SEEN = 'ntp_seen'
+UPGRADE_LAUNCHED = 'upgrade_launched'
+UPGRADE_COMPLETED = 'upgrade_completed'
+
+BUSY_TIMEOUT = 30
+STATE_MAX_AGE = 86400
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outcomes (
+    host TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    detail TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host, operation)
+)
+'''
+
+
+def default_state_path():
+    """Return the per-user state database location."""
+    base = os.getenv('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(base, 'ap_ccs3', 'fleet_state.db')
+
+
+class FleetState:
+    """Last outcome of each operation per AP, backed by SQLite."""
+
+    def __init__(self, path=None, force=False, max_age=STATE_MAX_AGE):
+        self.path = path or default_state_path()
+        self.force = force
+        self.max_age = max_age
+        if self.path != ':memory:':
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        if self.path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def last(self, host, operation):
+        """Return (ok, detail, updated_at) for the host's last run of the operation, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT ok, detail, updated_at FROM outcomes WHERE host = ? AND operation = ?',
+                (host, operation)).fetchone()
+        if row is None:
+            return None
+        return bool(row[0]), row[1], row[2]
+
+    def done(self, host, operation, detail=None):
+        """True if the operation last succeeded on the host (with the same detail, if given).
+
+        Always False when the store was opened with force=True, or when the
+        outcome is older than max_age seconds.
+        """
+        if self.force:
+            return False
+        last = self.last(host, operation)
+        if last is None or not last[0]:
+            return False
+        if self.max_age and time.time() - last[2] > self.max_age:
+            return False
+        return detail is None or last[1] == detail
+
+    def record(self, host, operation, ok, detail=''):
+        """Record the outcome of an operation on the host."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO outcomes (host, operation, ok, detail, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (host, operation, int(bool(ok)), detail, time.time()))
+            self._db.commit()
+
+    def rows(self, hosts=None):
+        """Return every recorded outcome, optionally only for the given hosts."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT host, operation, ok, detail, updated_at FROM outcomes ORDER BY host, operation').fetchall()
+        if hosts:
+            rows = [row for row in rows if row[0] in hosts]
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def add_state_args(parser):
+    """Add the state store options shared by the fleet tools."""
+    group = parser.add_argument_group('fleet state')
+    group.add_argument('--state-db', metavar='PATH',
+                       help='SQLite fleet state database (default: ~/.local/state/ap_ccs3/fleet_state.db).')
+    group.add_argument('--force', action='store_true',
+                       help='Redo work even where the state store says it is already done.')
+    group.add_argument('--state-max-age', type=float, default=STATE_MAX_AGE, metavar='SECONDS',
+                       help=f'Seconds a recorded outcome counts as done; 0 for no limit (default: {STATE_MAX_AGE}).')
+    group.add_argument('--no-state', action='store_true',
+                       help='Neither consult nor update the state store.')
+
+
+def state_from_args(args):
+    """Open the FleetState described by the add_state_args options."""
+    if args.no_state:
+        return FleetState(':memory:', force=args.force, max_age=args.state_max_age)
+    return FleetState(args.state_db, force=args.force, max_age=args.state_max_age)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the recorded fleet state per AP.')
+    parser.add_argument('hosts', nargs='*', help='Only show these hosts.')
+    parser.add_argument('--state-db', metavar='PATH', help='SQLite fleet state database.')
+    args = parser.parse_args()
+    with FleetState(args.state_db) as state:
+        for host, operation, ok, detail, updated_at in state.rows(set(args.hosts)):
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated_at))
+            print(f"{host}, {operation}, {'ok' if ok else 'failed'}, {when}, {detail}")
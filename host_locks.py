@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# host_locks.py
+# Cross-process coordination between the CCS3 AP tools on one controller.
+#
+# Per-AP locks: every tool locks an AP (flock on <dir>/hosts/<ip>.lock) for
+# as long as it has an SSH session on it. Tools that change the AP (upgrade,
+# firmware copy) take the lock exclusively; read-only audits take it shared,
+# and back off instead of logging in while another tool is upgrading or
+# copying to the same AP. An AP6 in the middle of yocto_ap6_upgrade.sh is
+# therefore never hit by a wave of audit logins.
+#
+# Global SSH budget: <dir>/ssh-slots holds one file per allowed session;
+# each SSH session of any tool holds a slot locked, so all the tools
+# together never exceed the budget, however many of them are running.
+#
+# flock locks go away when the process does, so a crashed tool never leaves
+# an AP or a slot locked.
+
+import fcntl
+import os
+import random
+import sys
+
+SSH_SLOTS = 64
+
+# Lock modes
+SHARED = fcntl.LOCK_SH
+EXCLUSIVE = fcntl.LOCK_EX
+
+
+def default_lock_dir():
+    """Return the per-user runtime directory for the lock files."""
+    runtime = os.getenv('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'ap_ccs3')
+    return f"/tmp/ap_ccs3-{os.getuid()}"
+
+
+class HostLocks:
+    """Per-AP flock locks and a global pool of SSH session slots."""
+
+    def __init__(self, directory=None, ssh_slots=SSH_SLOTS):
+        self.directory = directory or default_lock_dir()
+        os.makedirs(os.path.join(self.directory, 'hosts'), exist_ok=True)
+        self.ssh_slots = ssh_slots
+        self._slots = []
+        self._free = set()
+        if ssh_slots:
+            slot_dir = os.path.join(self.directory, 'ssh-slots')
+            os.makedirs(slot_dir, exist_ok=True)
+            self._slots = [os.open(os.path.join(slot_dir, f"slot-{index}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+                           for index in range(ssh_slots)]
+            self._free = set(range(ssh_slots))
+
+    def try_host(self, host, mode):
+        """Lock the host without waiting; return the lock's file descriptor, or None if it is held."""
+        fd = os.open(os.path.join(self.directory, 'hosts', f"{host}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        if mode == EXCLUSIVE:
+            # Tell anyone backing off who is working on the AP.
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, f"{os.path.basename(sys.argv[0])} (pid {os.getpid()})\n".encode(), 0)
+        return fd
+
+    def holder(self, host):
+        """Return who holds the host exclusively, as written by try_host, or ''."""
+        try:
+            with open(os.path.join(self.directory, 'hosts', f"{host}.lock")) as file:
+                return file.read().strip()
+        except OSError:
+            return ''
+
+    def release_host(self, fd):
+        os.close(fd)
+
+    def try_slot(self):
+        """Take a global SSH slot without waiting; return its index, or None if all are taken."""
+        candidates = list(self._free)
+        random.shuffle(candidates)
+        for index in candidates:
+            try:
+                fcntl.flock(self._slots[index], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            self._free.discard(index)
+            return index
+        return None
+
+    def release_slot(self, index):
+        fcntl.flock(self._slots[index], fcntl.LOCK_UN)
+        self._free.add(index)
+
+    def close(self):
+        for fd in self._slots:
+            os.close(fd)
+        self._slots = []
+        self._free = set()
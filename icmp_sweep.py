@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# icmp_sweep.py
+# Ping a whole inventory from one ICMP socket instead of forking ping per host.
+# Echo requests for every host are sent back to back, replies are collected
+# as they arrive, and a pass ends when everyone has answered or the timeout
+# expires. Hosts that stayed silent get another echo in the next pass, up to
+# SWEEP_ATTEMPTS passes, so one lost packet on a lossy backhaul does not
+# mark an AP down; a 500-host pre-check takes one timeout interval when
+# everyone answers, and at most SWEEP_ATTEMPTS of them.
+#
+# An unprivileged ICMP datagram socket is used where the kernel allows it
+# (net.ipv4.ping_group_range); otherwise a raw socket, which needs root or
+# CAP_NET_RAW. If neither can be opened, open_icmp_socket() raises OSError and
+# callers fall back to per-host ping.
+
+import itertools
+import os
+import select
+import socket
+import struct
+import time
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+SWEEP_TIMEOUT = 2.0
+SWEEP_ATTEMPTS = 3
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _echo_request(ident, seq):
+    payload = b'ccs3ping'
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+
+def open_icmp_socket():
+    """Return (socket, is_raw) for the best ICMP socket this process may open."""
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+    except OSError:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+
+
+def _resolve(hosts):
+    addresses = {}
+    for host in hosts:
+        try:
+            addresses.setdefault(socket.gethostbyname(host), []).append(host)
+        except OSError:
+            pass
+    return addresses
+
+
+def _send(sock, packet, address):
+    """Send one echo request; False if the address is unroutable."""
+    while True:
+        try:
+            sock.sendto(packet, (address, 0))
+            return True
+        except BlockingIOError:
+            select.select([], [sock], [], 0.05)
+        except OSError:
+            return False
+
+
+def sweep(hosts, timeout=SWEEP_TIMEOUT, attempts=SWEEP_ATTEMPTS):
+    """Ping every host from a single socket, re-sending to silent hosts up to attempts times.
+
+    Returns {host: rtt_seconds} for hosts that answered and {host: None} for
+    the rest. Raises OSError if no ICMP socket can be opened.
+    """
+    hosts = list(hosts)
+    results = dict.fromkeys(hosts)
+    addresses = _resolve(hosts)
+    sock, is_raw = open_icmp_socket()
+    ident = os.getpid() & 0xffff
+    # seq -> (address, send time); each echo has its own seq, so a late
+    # reply to an earlier pass is still timed from its own request.
+    sent = {}
+    seqs = itertools.count()
+    pending = set(addresses)
+    try:
+        sock.setblocking(False)
+        for _ in range(max(1, attempts)):
+            if not pending:
+                break
+            for address in list(pending):
+                seq = next(seqs) & 0xffff
+                if _send(sock, _echo_request(ident, seq), address):
+                    sent[seq] = (address, time.monotonic())
+                else:
+                    # Unroutable address: leave it unreachable.
+                    pending.discard(address)
+
+            deadline = time.monotonic() + timeout
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not select.select([sock], [], [], remaining)[0]:
+                    break
+                while True:
+                    try:
+                        packet, (address, _) = sock.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    received = time.monotonic()
+                    if is_raw:
+                        packet = packet[(packet[0] & 0x0f) * 4:]
+                    if len(packet) < 8:
+                        continue
+                    icmp_type, _, _, reply_ident, seq = struct.unpack('!BBHHH', packet[:8])
+                    if icmp_type != ICMP_ECHO_REPLY or address not in pending:
+                        continue
+                    if sent.get(seq, (None,))[0] != address:
+                        continue
+                    # Datagram sockets get their id rewritten by the kernel and
+                    # only ever see their own replies; raw sockets see everything.
+                    if is_raw and reply_ident != ident:
+                        continue
+                    pending.discard(address)
+                    for host in addresses[address]:
+                        results[host] = received - sent[seq][1]
+    finally:
+        sock.close()
+    return results
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# inventory.py
+# Shared host inventory loader for the CCS3 AP tools.
+# Hosts are read from one or more CSV files with an 'SNMP_Host' column ('-'
+# reads the CSV from stdin). Every file is opened and its header checked up
+# front, then rows are streamed lazily so dispatch can start before a large
+# inventory has been parsed. Addresses are validated with ipaddress and each
+# AP is yielded once, even if it appears several times or in several files.
+#
+# A HostSelection narrows the stream without hand-editing CSVs: set algebra
+# against other inventory files (--exclude failed.csv, --intersect ...),
+# CIDR blocks, last octets (.240/.241/.244) and a count limit. Exclude and
+# intersect files are loaded once into sets of integer addresses and CIDRs
+# are indexed by prefix length, so each host is checked with a handful of
+# set lookups however large the inventories are.
+#
+# A results CSV written by a previous run (results.py) is itself an
+# inventory, and --retry-from results.csv keeps only the inventory hosts that
+# failed in it; --reason narrows that to the failure reasons worth retrying.
+#
+# --shard I/N splits an inventory across N controller machines with no
+# overlap: each address is hashed (blake2b of its packed bytes, so the split
+# is the same on every machine and every Python run) and shard I keeps the
+# addresses whose hash falls in bucket I. Each shard writes its own results
+# file; results.py merges them into one report.
+
+import argparse
+import csv
+import hashlib
+import ipaddress
+import sys
+
+HOST_COLUMN = 'SNMP_Host'
+REASON_COLUMN = 'reason'
+STDIN = '-'
+
+
+def _open_csv(csv_file):
+    """Open one inventory CSV and check its header; exits on error like the tools always did."""
+    try:
+        file = sys.stdin if csv_file == STDIN else open(csv_file, mode='r', newline='')
+        csv_reader = csv.DictReader(file, delimiter=',')
+        if not csv_reader.fieldnames or HOST_COLUMN not in csv_reader.fieldnames:
+            raise ValueError(f"CSV file is missing '{HOST_COLUMN}' header.")
+        return file, csv_reader
+    except FileNotFoundError:
+        print(f"Error: The file {csv_file} was not found.")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error reading CSV file {csv_file}: {e}")
+        sys.exit(1)
+
+
+class HostSelection:
+    """Filter applied to the inventory stream; an empty selection keeps every host."""
+
+    def __init__(self, exclude_files=(), intersect_files=(), cidrs=(), octets=(), limit=None,
+                 retry_files=(), reasons=(), shard=None):
+        self.exclude = set()
+        for csv_file in exclude_files:
+            self.exclude.update(_address_keys(csv_file))
+        self.intersect = []
+        for csv_file in intersect_files:
+            self.intersect.append(set(_address_keys(csv_file)))
+        if retry_files:
+            retry = set()
+            for csv_file in retry_files:
+                retry.update(_retry_keys(csv_file, set(reasons)))
+            self.intersect.append(retry)
+        self.shard = shard
+        self.networks = {}
+        for cidr in cidrs:
+            network = ipaddress.ip_network(cidr, strict=False)
+            key = (network.version, network.prefixlen)
+            self.networks.setdefault(key, set()).add(int(network.network_address) >> (network.max_prefixlen - network.prefixlen))
+        self.octets = set(octets)
+        self.limit = limit
+
+    def accepts(self, address):
+        """Return True if the address passes every filter except the count limit."""
+        key = (address.version, int(address))
+        if key in self.exclude:
+            return False
+        if any(key not in members for members in self.intersect):
+            return False
+        if self.networks and not any(
+                version == address.version and (int(address) >> (address.max_prefixlen - prefixlen)) in prefixes
+                for (version, prefixlen), prefixes in self.networks.items()):
+            return False
+        if self.octets and (address.version != 4 or address.packed[-1] not in self.octets):
+            return False
+        if self.shard is not None and shard_of(address, self.shard[1]) != self.shard[0]:
+            return False
+        return True
+
+
+def shard_of(address, count):
+    """Return the 1-based shard (of count) an address belongs to, the same on every machine."""
+    digest = hashlib.blake2b(address.packed, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count + 1
+
+
+def _address_keys(csv_file):
+    """Return the (version, int) keys of every host in a CSV, for set operations."""
+    for host in read_hosts_from_csv(csv_file):
+        address = ipaddress.ip_address(host)
+        yield (address.version, int(address))
+
+
+def _retry_keys(csv_file, reasons):
+    """Return the keys of hosts that failed in a results CSV, only for the given reasons if any."""
+    file, csv_reader = _open_csv(csv_file)
+    if REASON_COLUMN not in csv_reader.fieldnames:
+        print(f"Error: {csv_file} is not a results file, it has no '{REASON_COLUMN}' column.")
+        sys.exit(1)
+
+    def failed(row):
+        reason = (row[REASON_COLUMN] or '').strip()
+        return bool(reason) and (not reasons or reason in reasons)
+
+    for host in _iter_hosts([(csv_file, file, csv_reader)], keep=failed):
+        address = ipaddress.ip_address(host)
+        yield (address.version, int(address))
+
+
+def _iter_hosts(sources, selection=None, keep=None):
+    seen = set()
+    selected = 0
+    for csv_file, file, csv_reader in sources:
+        try:
+            for row in csv_reader:
+                value = (row[HOST_COLUMN] or '').strip()
+                if not value or (keep is not None and not keep(row)):
+                    continue
+                try:
+                    address = ipaddress.ip_address(value)
+                except ValueError:
+                    print(f"Skipping invalid address '{value}' in {csv_file} line {csv_reader.line_num}.")
+                    continue
+                if address in seen:
+                    continue
+                seen.add(address)
+                if selection is not None:
+                    if not selection.accepts(address):
+                        continue
+                    if selection.limit is not None and selected >= selection.limit:
+                        return
+                selected += 1
+                yield str(address)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+
+def read_hosts_from_csv(csv_files, selection=None):
+    """Return a lazy iterator of unique, valid hosts from one or more CSV files.
+
+    The union of all files is taken, then narrowed by the HostSelection if given.
+    """
+    if isinstance(csv_files, str):
+        csv_files = [csv_files]
+    sources = [(csv_file,) + _open_csv(csv_file) for csv_file in csv_files]
+    return _iter_hosts(sources, selection)
+
+
+def _last_octets(value):
+    try:
+        octets = {int(octet.strip().lstrip('.')) for octet in value.split(',') if octet.strip()}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid octet list: {value}")
+    if not octets or any(octet < 0 or octet > 255 for octet in octets):
+        raise argparse.ArgumentTypeError(f"invalid octet list: {value}")
+    return octets
+
+
+def _cidr(value):
+    try:
+        ipaddress.ip_network(value, strict=False)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def _shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard, expected I/N: {value}")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard, expected 1 <= I <= N: {value}")
+    return index, count
+
+
+def add_inventory_args(parser):
+    """Add the inventory arguments shared by the fleet tools."""
+    # results.py reads inventories itself, so it is imported here rather than at the top.
+    from results import REASONS
+
+    parser.add_argument('csv_file',
+                        help="Path to the CSV file containing host information ('-' for stdin); "
+                             "a results CSV of an earlier run works too.")
+    parser.add_argument('--csv', action='append', default=[], metavar='CSV_FILE', dest='extra_csv_files',
+                        help='Additional inventory CSV to merge in (repeatable); duplicates are skipped.')
+    group = parser.add_argument_group('host selection')
+    group.add_argument('--exclude', action='append', default=[], metavar='CSV_FILE',
+                       help='Skip hosts listed in this CSV, e.g. failed.csv (repeatable).')
+    group.add_argument('--intersect', action='append', default=[], metavar='CSV_FILE',
+                       help='Only keep hosts also listed in this CSV (repeatable).')
+    group.add_argument('--cidr', action='append', default=[], type=_cidr, metavar='NETWORK',
+                       help='Only keep hosts inside this network, e.g. 10.90.4.0/24 (repeatable).')
+    group.add_argument('--octet', type=_last_octets, default=set(), metavar='N[,N...]',
+                       help='Only keep hosts whose last octet is listed, e.g. 240,241,244.')
+    group.add_argument('--limit', type=int, metavar='N',
+                       help='Stop after the first N selected hosts.')
+    group.add_argument('--retry-from', action='append', default=[], metavar='RESULTS_CSV',
+                       help='Only keep hosts that failed in this results file of an earlier run (repeatable).')
+    group.add_argument('--reason', action='append', default=[], choices=REASONS, metavar='REASON',
+                       help=f"With --retry-from, only retry hosts that failed for this reason: "
+                            f"{', '.join(REASONS)} (repeatable).")
+    group.add_argument('--shard', type=_shard, metavar='I/N',
+                       help='Only keep shard I of N of the inventory, split by a stable hash of the address, '
+                            'so N controllers can share one CSV without overlap, e.g. 2/3.')
+
+
+def inventory_files(args):
+    """Return every inventory CSV named on the command line."""
+    return [args.csv_file] + args.extra_csv_files
+
+
+def selection_from_args(args):
+    """Build the HostSelection described by the add_inventory_args options."""
+    return HostSelection(args.exclude, args.intersect, args.cidr, args.octet, args.limit,
+                         args.retry_from, args.reason, args.shard)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Print the validated, de-duplicated and selected hosts of one or more inventory CSVs.')
+    add_inventory_args(parser)
+    args = parser.parse_args()
+    hosts = read_hosts_from_csv(inventory_files(args), selection_from_args(args))
+    print(HOST_COLUMN)
+    for host in hosts:
+        print(host)
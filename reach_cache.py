@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# reach_cache.py
+# On-disk reachability cache shared by every CCS3 AP tool run on this controller.
+# Each host maps to whether it was last seen up or down, the measured RTT
+# and when that was. Up entries younger than the TTL are trusted, so running
+# the copy, check and upgrade tools back to back against the same CSV does
+# not re-probe every AP. Down entries are only trusted for the much shorter
+# down TTL: a miss may be a lost packet, and an AP wrongly cached as down
+# would fail every run until its entry expired.
+#
+# The cache is a small JSON file. Saves re-read the file under an exclusive
+# lock and merge by timestamp, so tools running at the same time don't
+# overwrite each other's results. Entries older than max_age are evicted,
+# and at most max_entries of the newest entries are kept.
+
+import fcntl
+import json
+import os
+import time
+
+CACHE_TTL = 300
+CACHE_DOWN_TTL = 30
+CACHE_MAX_AGE = 86400
+CACHE_MAX_ENTRIES = 100000
+
+
+def default_cache_path():
+    """Return the per-user cache file location."""
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ap_ccs3', 'reachability.json')
+
+
+class ReachabilityCache:
+    """host -> {'up': bool, 'rtt': seconds or None, 'ts': epoch seconds}."""
+
+    def __init__(self, path=None, ttl=CACHE_TTL, down_ttl=CACHE_DOWN_TTL, max_age=CACHE_MAX_AGE,
+                 max_entries=CACHE_MAX_ENTRIES):
+        self.path = path or default_cache_path()
+        self.ttl = ttl
+        self.down_ttl = min(down_ttl, ttl)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.entries = self._read()
+        self._dirty = {}
+
+    def _read(self):
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def lookup(self, host):
+        """Return (up, rtt) if the host has a fresh entry, otherwise None."""
+        entry = self._dirty.get(host) or self.entries.get(host)
+        if entry is None or time.time() - entry['ts'] > (self.ttl if entry['up'] else self.down_ttl):
+            return None
+        return entry['up'], entry['rtt']
+
+    def record(self, host, up, rtt=None):
+        """Remember that the host was just seen up or down."""
+        self._dirty[host] = {'up': bool(up), 'rtt': rtt, 'ts': time.time()}
+
+    def save(self):
+        """Merge new results into the cache file, evicting old entries."""
+        if not self._dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._read()
+            for host, entry in self._dirty.items():
+                if host not in entries or entries[host]['ts'] <= entry['ts']:
+                    entries[host] = entry
+            cutoff = time.time() - self.max_age
+            entries = {host: entry for host, entry in entries.items() if entry['ts'] >= cutoff}
+            if len(entries) > self.max_entries:
+                newest = sorted(entries, key=lambda host: entries[host]['ts'], reverse=True)
+                entries = {host: entries[host] for host in newest[:self.max_entries]}
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as file:
+                json.dump(entries, file)
+            os.replace(temp_path, self.path)
+        self.entries = entries
+        self._dirty = {}
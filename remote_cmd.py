@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# remote_cmd.py
+# Run commands on an AP and return as soon as they have actually finished.
+# Each command gets its own exec channel on the host's pooled transport, and
+# completion is driven by the exit status the AP sends back rather than by
+# sleeping and scraping a prompt. No pty or login shell is requested, so
+# there is no PS1 rewriting, no echo to strip and no prompt regex to match.
+
+import select
+import time
+from collections import namedtuple
+
+READ_SIZE = 32768
+COMMAND_TIMEOUT = 30
+
+CommandResult = namedtuple('CommandResult', ['command', 'exit_status', 'stdout', 'stderr'])
+
+
+class CommandTimeout(Exception):
+    """Raised when a remote command does not finish within its timeout."""
+
+
+def _decode(data, encoding):
+    return data if encoding is None else data.decode(encoding, 'replace')
+
+
+def run_command(client, command, timeout=COMMAND_TIMEOUT, stdin=None, encoding='utf-8'):
+    """Run a command on a connected client and wait for its exit status.
+
+    stdin, if given, is sent to the command before its input is closed.
+    With encoding=None the output is returned as raw bytes.
+    """
+    runner = getattr(client, 'run_command', None)
+    if runner is not None:
+        # ssh_mux clients run commands through the system ssh binary.
+        return runner(command, timeout=timeout, stdin=stdin, encoding=encoding)
+    channel = client.get_transport().open_session(timeout=timeout)
+    try:
+        channel.exec_command(command)
+        if stdin is not None:
+            channel.sendall(stdin)
+        channel.shutdown_write()
+        stdout = []
+        stderr = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            while channel.recv_ready():
+                stdout.append(channel.recv(READ_SIZE))
+            while channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(READ_SIZE))
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            wait = 0.5
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CommandTimeout(f"'{command}' did not finish within {timeout} seconds")
+                wait = min(wait, remaining)
+            select.select([channel], [], [], wait)
+        return CommandResult(
+            command,
+            channel.recv_exit_status(),
+            _decode(b''.join(stdout), encoding),
+            _decode(b''.join(stderr), encoding),
+        )
+    finally:
+        channel.close()
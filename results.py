@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# results.py
+# Reason-coded per-host results shared by the CCS3 AP tools.
+# Every run writes one row per AP to a results CSV in the same 'SNMP_Host'
+# format as the inventory, with the outcome, why a host failed (unreachable,
+# auth_failed, timeout, file_missing, command_error, or busy when another
+# tool was working on the AP), the phase it failed in and the seconds spent
+# working on it. The file is a valid inventory on its own, so
+# 'results.csv --retry-from results.csv --reason timeout' re-runs exactly the
+# hosts worth retrying instead of a fresh full-fleet pass.
+#
+# Rows are written as hosts finish into a temporary file that replaces the
+# results file when the run ends (the temporary file is left behind if the
+# run is killed), so a run may safely retry from the file it is about to
+# overwrite.
+#
+# Results of several runs (shards of one inventory split across controllers,
+# or a run and its retries) are combined by running this module:
+#   ./results.py shard1.csv shard2.csv shard3.csv -o fleet_results.csv
+# A host listed in several files keeps its row from the last file given.
+
+import argparse
+import csv
+import errno
+import os
+import socket
+import sys
+from collections import Counter
+
+import paramiko
+from paramiko.ssh_exception import NoValidConnectionsError
+
+from inventory import HOST_COLUMN, REASON_COLUMN
+from remote_cmd import CommandTimeout
+
+UNREACHABLE = 'unreachable'
+AUTH_FAILED = 'auth_failed'
+TIMEOUT = 'timeout'
+FILE_MISSING = 'file_missing'
+COMMAND_ERROR = 'command_error'
+BUSY = 'busy'
+REASONS = (UNREACHABLE, AUTH_FAILED, TIMEOUT, FILE_MISSING, COMMAND_ERROR, BUSY)
+
+REACH = 'reach'
+LOCK = 'lock'
+LOGIN = 'login'
+TRANSFER = 'transfer'
+COMMAND = 'command'
+VERIFY = 'verify'
+# An error in the tool's own per-host code rather than on the AP.
+TOOL = 'tool'
+
+FIELDS = [HOST_COLUMN, 'status', REASON_COLUMN, 'phase', 'elapsed', 'detail']
+
+
+class HostFailure(Exception):
+    """Raised by a tool's per-host work to fail the host with a reason and phase."""
+
+    def __init__(self, reason, phase, detail=''):
+        super().__init__(detail or reason)
+        self.reason = reason
+        self.phase = phase
+        self.detail = detail
+
+
+def classify(exc):
+    """Map an exception raised while working on a host to a failure reason."""
+    if isinstance(exc, paramiko.AuthenticationException):
+        return AUTH_FAILED
+    if isinstance(exc, (socket.timeout, TimeoutError, CommandTimeout)):
+        return TIMEOUT
+    if isinstance(exc, FileNotFoundError):
+        return FILE_MISSING
+    if isinstance(exc, paramiko.SSHException):
+        return TIMEOUT if 'timed out' in str(exc).lower() else COMMAND_ERROR
+    if isinstance(exc, (ConnectionError, EOFError, socket.gaierror, NoValidConnectionsError)):
+        return UNREACHABLE
+    if isinstance(exc, OSError) and exc.errno in (errno.EHOSTUNREACH, errno.ENETUNREACH):
+        return UNREACHABLE
+    return COMMAND_ERROR
+
+
+def failure(exc, phase):
+    """Return a HostFailure describing the exception raised in the given phase."""
+    return HostFailure(classify(exc), phase, str(exc) or type(exc).__name__)
+
+
+def default_results_path(tag=None):
+    """Return '<tool>_results.csv' (or '<tool>_results.<tag>.csv') in the current directory."""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'fleet'
+    return f"{tool}_results.csv" if tag is None else f"{tool}_results.{tag}.csv"
+
+
+class ResultsWriter:
+    """Write one reason-coded row per host to a results CSV."""
+
+    def __init__(self, path=None):
+        self.path = path or default_results_path()
+        self._temp_path = f"{self.path}.{os.getpid()}.tmp"
+        self._file = None
+        self._writer = None
+
+    def _open(self):
+        self._file = open(self._temp_path, mode='w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=FIELDS)
+        self._writer.writeheader()
+
+    def write(self, host, status, reason='', phase='', elapsed=0.0, detail=''):
+        if self._file is None:
+            self._open()
+        self._writer.writerow({
+            HOST_COLUMN: host,
+            'status': status,
+            REASON_COLUMN: reason,
+            'phase': phase,
+            'elapsed': f"{elapsed:.2f}",
+            'detail': ' '.join(detail.split()),
+        })
+        self._file.flush()
+
+    def close(self):
+        """Move the finished results into place; an empty run still gets a header-only file."""
+        if self._file is None:
+            self._open()
+        if self._file.closed:
+            return
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+        print(f"Results written to {self.path}")
+
+
+def merge_results(paths):
+    """Return the rows of several results files, one per host, later files winning."""
+    rows = {}
+    for path in paths:
+        try:
+            with open(path, mode='r', newline='') as file:
+                csv_reader = csv.DictReader(file)
+                missing = [field for field in FIELDS if field not in (csv_reader.fieldnames or [])]
+                if missing:
+                    raise ValueError(f"not a results file, missing {', '.join(missing)}")
+                for row in csv_reader:
+                    host = (row[HOST_COLUMN] or '').strip()
+                    if host:
+                        rows.pop(host, None)
+                        rows[host] = {field: row[field] for field in FIELDS}
+        except FileNotFoundError:
+            print(f"Error: The file {path} was not found.")
+            sys.exit(1)
+        except Exception as e:
+            print(f"Error reading results file {path}: {e}")
+            sys.exit(1)
+    return list(rows.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge the results files of several runs or shards into one report.')
+    parser.add_argument('results_files', nargs='+', help='Results CSV files to merge.')
+    parser.add_argument('-o', '--output', default='merged_results.csv',
+                        help='Merged results CSV to write (default: merged_results.csv).')
+    args = parser.parse_args()
+
+    rows = merge_results(args.results_files)
+    with open(args.output, mode='w', newline='') as file:
+        csv_writer = csv.DictWriter(file, fieldnames=FIELDS)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+    reasons = Counter(row[REASON_COLUMN] for row in rows if row['status'] != 'good')
+    print(f"{len(rows)} hosts merged into {args.output}: "
+          f"{len(rows) - sum(reasons.values())} good, {sum(reasons.values())} bad.")
+    for reason, count in reasons.most_common():
+        print(f"{reason or 'unknown'}: {count}")
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# sftp_upload.py
+# Upload several files to an AP over one SFTP session.
+# All remote files are opened up front with pipelined writes (no waiting for
+# each write to be acknowledged) and fed chunk by chunk in turn, so every
+# file is in flight at once on a single authenticated connection and a
+# small upgrade script does not wait behind a large .dist image. Each remote
+# size is checked against the local one once its acknowledgements are in.
+# Chunks are memoryview slices of the artifact's shared read-only mapping
+# (artifacts.shared_buffer), so no upload keeps its own copy of the file.
+#
+# stage_files() adds delta staging on top: files whose remote size and
+# digest already match the local artifact are not sent at all, and every
+# file that is sent has its digest checked on the AP in the same session,
+# so a successful copy also proves the files are intact.
+#
+# Uploads are resumable. Files are written to '<name>.part' and renamed into
+# place once verified; if a link drops mid-transfer, the next attempt hashes
+# the partial file on the AP and, if it matches the same prefix of the local
+# artifact, carries on from where the transfer stopped instead of byte zero.
+
+import contextlib
+import os
+import shlex
+import time
+from collections import namedtuple
+
+from artifacts import file_digest, prefix_digest, remote_digests, shared_buffer
+from remote_cmd import run_command
+
+CHUNK_SIZE = 32768
+PART_SUFFIX = '.part'
+
+# sent is the number of bytes actually uploaded: 0 for a file already on the
+# AP, less than size for a resumed upload.
+Transfer = namedtuple('Transfer', ['local_path', 'remote_path', 'size', 'seconds', 'sent'])
+
+
+def throughput(transfer):
+    """Return the transfer's throughput in Mbit/s."""
+    return transfer.sent * 8 / 1e6 / transfer.seconds if transfer.seconds > 0 else 0.0
+
+
+def upload_files(sftp, uploads, throttle=None):
+    """Upload (local_path, remote_path, offset) items over one SFTP session.
+
+    Each file is written from offset on, after whatever the remote file
+    already holds. throttle, if given, is called with each chunk's size
+    before it is sent and may sleep to hold a rate limit. Returns a Transfer
+    per item, in the order given. Raises IOError if a remote file does not
+    end up the same size as the local one.
+    """
+    started = time.monotonic()
+    streams = []
+    elapsed = {}
+    with contextlib.ExitStack() as stack:
+        for local_path, remote_path, offset in uploads:
+            remote = stack.enter_context(sftp.open(remote_path, 'r+b' if offset else 'wb'))
+            remote.seek(offset)
+            remote.set_pipelined(True)
+            streams.append([local_path, shared_buffer(local_path), offset, remote])
+        active = list(streams)
+        while active:
+            for stream in list(active):
+                local_path, buffer, position, remote = stream
+                chunk = buffer[position:position + CHUNK_SIZE]
+                if chunk:
+                    if throttle is not None:
+                        throttle(len(chunk))
+                    remote.write(chunk)
+                    stream[2] += len(chunk)
+                    continue
+                # Closing waits for the outstanding write acknowledgements.
+                remote.close()
+                elapsed[local_path] = time.monotonic() - started
+                active.remove(stream)
+
+    results = []
+    for local_path, remote_path, offset in uploads:
+        size = os.path.getsize(local_path)
+        remote_size = sftp.stat(remote_path).st_size
+        if remote_size != size:
+            raise IOError(f"size mismatch in upload of {local_path}: {remote_size} != {size}")
+        results.append(Transfer(local_path, remote_path, size, elapsed[local_path], size - offset))
+    return results
+
+
+class ChecksumMismatch(IOError):
+    """Raised when a file on the AP does not match the local artifact after upload."""
+
+
+def _remote_size(sftp, path):
+    try:
+        return sftp.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+def staging_paths(file_paths, destination):
+    """Return {local path: remote path} and {local path: .part path} for the files staged in the destination."""
+    remote_paths = {path: f"{destination}/{os.path.basename(path)}" for path in file_paths}
+    return remote_paths, {path: remote_paths[path] + PART_SUFFIX for path in file_paths}
+
+
+def finish_parts(client, file_paths, destination, algorithm='sha256', timeout=None, verify=True, how='upload',
+                 run=run_command):
+    """Check the staged .part copies of the files on the AP and rename them into place.
+
+    Every way of staging files (SFTP, scp, relay, HTTP fetch) ends here.
+    run(client, command, timeout=...) runs a shell command on the AP. With
+    verify=False, for an AP without <algorithm>sum, only the rename is done.
+    how names the transfer in errors. Raises ChecksumMismatch, after removing
+    the bad copy, if a digest is wrong, and IOError if the files cannot be
+    renamed.
+    """
+    if not file_paths:
+        return
+    remote_paths, part_paths = staging_paths(file_paths, destination)
+    if verify:
+        remote = remote_digests(client, list(part_paths.values()), algorithm, timeout) or {}
+        for path in file_paths:
+            if remote.get(part_paths[path]) != file_digest(path, algorithm):
+                run(client, f"rm -f {shlex.quote(part_paths[path])}", timeout=timeout)
+                raise ChecksumMismatch(f"{algorithm} mismatch for {remote_paths[path]} after {how}")
+    result = run(client, ' && '.join(
+        f"mv -f {shlex.quote(part_paths[path])} {shlex.quote(remote_paths[path])}" for path in file_paths),
+        timeout=timeout)
+    if result.exit_status != 0:
+        raise IOError(f"could not rename the files after {how}: {result.stderr.strip()}")
+
+
+def stage_files(client, sftp, file_paths, destination, algorithm='sha256', timeout=None, throttle=None):
+    """Make the destination hold identical copies of the files, sending only what differs.
+
+    Returns (transfers, verified): a Transfer per file, in the order given
+    (sent is 0 for files already present), and whether every file's digest
+    was confirmed on the AP. Raises ChecksumMismatch if an uploaded file's
+    digest on the AP is wrong. If the AP cannot compute digests, every file
+    is sent from the start, only sizes are checked and verified is False.
+    throttle is passed on to upload_files.
+    """
+    remote_paths, part_paths = staging_paths(file_paths, destination)
+    local = {path: file_digest(path, algorithm) for path in file_paths}
+
+    # Only files of the right size are worth hashing on the AP.
+    same_size = [remote_paths[path] for path in file_paths
+                 if _remote_size(sftp, remote_paths[path]) == os.path.getsize(path)]
+    remote = remote_digests(client, same_size, algorithm, timeout) if same_size else {}
+    verify = remote is not None
+    remote = remote or {}
+    missing = [path for path in file_paths if remote.get(remote_paths[path]) != local[path]]
+
+    # Resume partial uploads whose content matches the start of the artifact;
+    # a complete one only needs renaming into place.
+    offsets = dict.fromkeys(missing, 0)
+    if verify:
+        partial = {path: _remote_size(sftp, part_paths[path]) for path in missing}
+        partial = {path: size for path, size in partial.items() if size and size <= os.path.getsize(path)}
+        remote = remote_digests(client, [part_paths[path] for path in partial], algorithm, timeout) or {}
+        for path, size in partial.items():
+            if remote.get(part_paths[path]) == prefix_digest(path, size, algorithm):
+                offsets[path] = size
+
+    uploaded = {transfer.local_path: transfer
+                for transfer in upload_files(sftp, [(path, part_paths[path], offsets[path]) for path in missing
+                                                    if offsets[path] < os.path.getsize(path)], throttle)}
+
+    finish_parts(client, missing, destination, algorithm, timeout, verify)
+
+    transfers = []
+    for path in file_paths:
+        if path in uploaded:
+            transfers.append(uploaded[path]._replace(remote_path=remote_paths[path]))
+        else:
+            transfers.append(Transfer(path, remote_paths[path], os.path.getsize(path), 0.0, 0))
+    return transfers, verify
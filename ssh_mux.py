@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# ssh_mux.py
+# OpenSSH ControlMaster backend, for deployments that must use the system
+# ssh/scp binaries instead of paramiko.
+# Each AP gets one master connection (ssh -M) with ControlPersist, on a
+# socket in the per-user runtime directory. Every later ssh command and scp
+# to that AP rides the master instead of repeating key exchange and password
+# auth, and that includes runs of the other tools: the firmware copy, the
+# follow-up file check and the upgrade push all share one login while the
+# master persists.
+#
+# The password goes to ssh through sshpass -e when it is installed,
+# otherwise through an SSH_ASKPASS helper that reads it from the
+# environment (OpenSSH 8.4+); it never appears on a command line. The
+# helper is written fresh for each login under a random name and removed
+# afterwards, and the socket directory must be a private directory of this
+# user, so nobody else can plant a helper or a socket in it. Slave sessions
+# run with BatchMode, so a dead master fails fast instead of prompting.
+# Stale sockets are removed, and before a new master is started the least
+# recently used ones are stopped until fewer than max_masters remain,
+# counting every tool's masters in the directory; masters this run is using
+# are never stopped.
+#
+# An SSH algorithm profile (ssh_profiles.py) is passed to the master as
+# Ciphers/MACs/KexAlgorithms options.
+
+import functools
+import os
+import secrets
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import paramiko
+
+from artifacts import file_digest, remote_digests
+from host_locks import default_lock_dir
+from remote_cmd import COMMAND_TIMEOUT, CommandResult, CommandTimeout
+from sftp_upload import Transfer, finish_parts, staging_paths
+from ssh_pool import CONNECT_TIMEOUT, SSH_PORT, SSH_USERNAME, SSHPool
+
+CONTROL_PERSIST = 600
+MAX_MASTERS = 64
+COPY_TIMEOUT = 600
+ASKPASS_PREFIX = 'askpass-'
+ASKPASS_SCRIPT = '#!/bin/sh\nprintf \'%s\\n\' "$SSHPASS"\n'
+
+MuxSettings = namedtuple('MuxSettings', ['control_dir', 'persist', 'max_masters'])
+
+
+def default_control_dir():
+    """Return the per-user directory of the master sockets."""
+    return os.path.join(default_lock_dir(), 'mux')
+
+
+def private_dir(path):
+    """Create path as a directory only this user can use; refuse one another user could have planted.
+
+    Raises PermissionError if path is a symlink or not owned by this user,
+    or if its parent could let another user replace it.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if stat.S_ISLNK(info.st_mode) or not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a directory owned by this user")
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    parent = os.path.dirname(os.path.abspath(path))
+    info = os.stat(parent)
+    # A parent others may write to is only safe with the sticky bit, like /tmp.
+    if info.st_uid not in (0, os.getuid()) or (info.st_mode & 0o022 and not info.st_mode & stat.S_ISVTX):
+        raise PermissionError(f"{parent} could be changed by another user")
+    return path
+
+
+def _socket_alive(path):
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+@functools.lru_cache(maxsize=None)
+def scp_protocol_options():
+    """Return the scp options that select the classic scp protocol.
+
+    OpenSSH 9.0+ scp speaks SFTP by default, which needs an sftp-server on
+    the AP; dropbear only has scp. Older scp has no -O and always speaks scp.
+    """
+    usage = subprocess.run(['scp', '-O'], stdin=subprocess.DEVNULL, capture_output=True, text=True).stderr
+    return [] if 'illegal option' in usage or 'unknown option' in usage else ['-O']
+
+
+def _decode(data, encoding):
+    return data if encoding is None else data.decode(encoding, 'replace')
+
+
+class MuxClient:
+    """Commands and copies to one AP over its master connection."""
+
+    def __init__(self, pool, host):
+        self.pool = pool
+        self.host = host
+
+    def run_command(self, command, timeout=COMMAND_TIMEOUT, stdin=None, encoding='utf-8'):
+        """Run a command on the AP, like remote_cmd.run_command, and return its CommandResult."""
+        self.pool.touch(self.host)
+        if isinstance(stdin, str):
+            stdin = stdin.encode()
+        try:
+            completed = subprocess.run(['ssh', *self.pool.slave_options(self.host), self.host, command],
+                                       input=stdin or b'', capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise CommandTimeout(f"'{command}' did not finish within {timeout} seconds")
+        if completed.returncode == 255 and not self.pool.alive(self.host):
+            raise ConnectionError(f"master connection to {self.host} lost: {completed.stderr.decode().strip()}")
+        return CommandResult(command, completed.returncode, _decode(completed.stdout, encoding),
+                             _decode(completed.stderr, encoding))
+
+    def copy(self, local_path, remote_path, timeout=COPY_TIMEOUT):
+        """scp a local file to remote_path on the AP."""
+        self.pool.touch(self.host)
+        try:
+            completed = subprocess.run(['scp', '-q', *scp_protocol_options(), *self.pool.slave_options(self.host),
+                                        local_path,
+                                        f"{self.host}:{remote_path}"],
+                                       stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise CommandTimeout(f"scp of {local_path} to {self.host} did not finish within {timeout} seconds")
+        if completed.returncode != 0:
+            raise IOError(f"scp of {local_path} to {self.host} failed: {completed.stderr.decode().strip()}")
+
+    def local_address(self):
+        """Return the controller address as the AP sees it (from $SSH_CONNECTION)."""
+        fields = self.run_command('echo $SSH_CONNECTION').stdout.split()
+        if not fields:
+            raise ConnectionError(f"{self.host} did not report SSH_CONNECTION")
+        return fields[0]
+
+
+class MuxPool:
+    """Per-host OpenSSH ControlMaster connections, with the same get/close interface as SSHPool."""
+
+    def __init__(self, password, username=SSH_USERNAME, port=SSH_PORT, timeout=CONNECT_TIMEOUT,
+                 control_dir=None, persist=CONTROL_PERSIST, max_masters=MAX_MASTERS, profile=None):
+        if not password:
+            raise ValueError("No SSH password given to the connection pool.")
+        self.password = password
+        self.username = username
+        self.port = port
+        self.timeout = timeout
+        self.control_dir = control_dir or default_control_dir()
+        self.persist = persist
+        self.max_masters = max_masters
+        self.profile = profile
+        private_dir(self.control_dir)
+        self._clients = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+        self._room_lock = threading.Lock()
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def control_path(self, host):
+        return os.path.join(self.control_dir, f"{self.username}@{host}:{self.port}")
+
+    def _options(self, host):
+        return ['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'LogLevel=ERROR',
+                '-o', f'User={self.username}', '-o', f'Port={self.port}',
+                '-o', f'ControlPath={self.control_path(host)}']
+
+    def slave_options(self, host):
+        """Return the ssh/scp options that make a session ride the host's master."""
+        return self._options(host) + ['-o', 'ControlMaster=no', '-o', 'BatchMode=yes']
+
+    def _profile_options(self):
+        """Return the ssh options for the algorithm profile; '^' puts its algorithms ahead of ssh's own."""
+        if self.profile is None:
+            return []
+        options = []
+        for option, preferred in (('Ciphers', self.profile.ciphers), ('MACs', self.profile.macs),
+                                  ('KexAlgorithms', self.profile.kex)):
+            if preferred:
+                options += ['-o', f"{option}={'' if self.profile.strict else '^'}{','.join(preferred)}"]
+        return options
+
+    def alive(self, host):
+        return _socket_alive(self.control_path(host))
+
+    def touch(self, host):
+        """Mark the host's master as just used; _make_room stops the least recently used first."""
+        try:
+            os.utime(self.control_path(host))
+        except OSError:
+            pass
+
+    def _askpass(self):
+        """Write a new askpass helper that only this user can run, and return its path."""
+        path = os.path.join(self.control_dir, f"{ASKPASS_PREFIX}{secrets.token_hex(8)}")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o700)
+        with os.fdopen(fd, 'w') as file:
+            file.write(ASKPASS_SCRIPT)
+        return path
+
+    def _make_room(self):
+        """Remove stale sockets and stop the least recently used masters until one more fits."""
+        with self._lock:
+            leased = {self.control_path(host) for host in self._clients}
+        masters = []
+        for name in os.listdir(self.control_dir):
+            path = os.path.join(self.control_dir, name)
+            if name.startswith(ASKPASS_PREFIX) or name.endswith('.tmp'):
+                continue
+            if not _socket_alive(path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            masters.append((os.lstat(path).st_mtime, path))
+        masters.sort()
+        idle = [path for _, path in masters if path not in leased]
+        count = len(masters)
+        while count >= self.max_masters and idle:
+            path = idle.pop(0)
+            count -= 1
+            # -O stop lets sessions in progress finish before the master exits.
+            subprocess.run(['ssh', '-o', f'ControlPath={path}', '-O', 'stop', 'master'],
+                           stdin=subprocess.DEVNULL, capture_output=True)
+
+    def _start_master(self, host, timeout):
+        with self._room_lock:
+            self._make_room()
+        command = ['ssh', *self._options(host), *self._profile_options(),
+                   '-o', 'ControlMaster=yes', '-o', f'ControlPersist={self.persist}',
+                   '-o', f'ConnectTimeout={int(timeout)}', '-o', 'PubkeyAuthentication=no',
+                   '-o', 'NumberOfPasswordPrompts=1', '-N', '-f', host]
+        env = dict(os.environ, SSHPASS=self.password)
+        askpass = None
+        if shutil.which('sshpass'):
+            command = ['sshpass', '-e'] + command
+        else:
+            askpass = self._askpass()
+            env.update(SSH_ASKPASS=askpass, SSH_ASKPASS_REQUIRE='force')
+        # The backgrounded master inherits stderr, so collect it in a file
+        # rather than a pipe that would stay open for as long as it runs.
+        try:
+            with tempfile.TemporaryFile() as errors:
+                try:
+                    returncode = subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+                                                stdout=subprocess.DEVNULL, stderr=errors,
+                                                timeout=timeout * 2).returncode
+                except subprocess.TimeoutExpired:
+                    raise TimeoutError(f"SSH login to {host} timed out")
+                errors.seek(0)
+                message = errors.read().decode(errors='replace').strip()
+        finally:
+            # The master has logged in (or given up) by now; -f only returns after authentication.
+            if askpass is not None:
+                os.unlink(askpass)
+        if returncode != 0 or not self.alive(host):
+            if returncode == 5 or 'Permission denied' in message:
+                raise paramiko.AuthenticationException(f"Authentication failed for {host}: {message}")
+            raise ConnectionError(f"Could not open a master connection to {host}: {message}")
+
+    def get(self, host, timeout=None):
+        """Return a MuxClient for the host, starting its master on first use."""
+        with self._host_lock(host):
+            if not self.alive(host):
+                self._start_master(host, timeout or self.timeout)
+            # The socket's mtime tells _make_room which masters were used last.
+            self.touch(host)
+            with self._lock:
+                return self._clients.setdefault(host, MuxClient(self, host))
+
+    def close(self, host):
+        """Forget the host; its master persists for later runs until ControlPersist runs out."""
+        with self._lock:
+            self._clients.pop(host, None)
+
+    def close_all(self):
+        with self._lock:
+            self._clients.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close_all()
+
+
+def stage_files(client, file_paths, destination, algorithm='sha256', timeout=None):
+    """Make the destination hold identical copies of the files over scp, sending only what differs.
+
+    The scp counterpart of sftp_upload.stage_files, with the same return
+    value and errors, except that a cut transfer starts over.
+    """
+    remote_paths, part_paths = staging_paths(file_paths, destination)
+    local = {path: file_digest(path, algorithm) for path in file_paths}
+
+    remote = remote_digests(client, list(remote_paths.values()), algorithm, timeout)
+    verify = remote is not None
+    missing = [path for path in file_paths if (remote or {}).get(remote_paths[path]) != local[path]]
+
+    copied = {}
+    for path in missing:
+        started = time.monotonic()
+        client.copy(path, part_paths[path])
+        size = os.path.getsize(path)
+        copied[path] = Transfer(path, remote_paths[path], size, time.monotonic() - started, size)
+
+    finish_parts(client, missing, destination, algorithm, timeout, verify)
+
+    return [copied.get(path) or Transfer(path, remote_paths[path], os.path.getsize(path), 0.0, 0)
+            for path in file_paths], verify
+
+
+def add_mux_args(parser):
+    """Add the options for the OpenSSH ControlMaster backend."""
+    group = parser.add_argument_group('OpenSSH backend')
+    group.add_argument('--openssh', action='store_true',
+                       help='Use the system ssh/scp over per-AP ControlMaster connections instead of paramiko.')
+    group.add_argument('--control-dir', metavar='PATH',
+                       help='Directory of the master sockets (default: $XDG_RUNTIME_DIR/ap_ccs3/mux).')
+    group.add_argument('--control-persist', type=int, default=CONTROL_PERSIST, metavar='SECONDS',
+                       help=f'Seconds an idle master stays up for later runs (default: {CONTROL_PERSIST}).')
+    group.add_argument('--max-masters', type=int, default=MAX_MASTERS,
+                       help=f'Maximum open master connections on this controller (default: {MAX_MASTERS}).')
+
+
+def mux_from_args(args):
+    """Return MuxSettings from the add_mux_args options, or None without --openssh."""
+    if not args.openssh:
+        return None
+    return MuxSettings(args.control_dir, args.control_persist, args.max_masters)
+
+
+def open_pool(password, fleet, mux=None):
+    """Return the tool's connection pool: paramiko sessions, or OpenSSH masters with MuxSettings."""
+    if mux is None:
+        return SSHPool(password, sock_source=fleet.take_socket, profile=fleet.ssh_profile)
+    # ssh cannot take over a socket probed by --reach ssh, so none are kept.
+    fleet.keep_probe_sockets = False
+    try:
+        return MuxPool(password, control_dir=mux.control_dir, persist=mux.persist, max_masters=mux.max_masters,
+                       profile=fleet.ssh_profile)
+    except PermissionError as e:
+        print(f"Error: Unsafe control directory: {e}")
+        sys.exit(1)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# ssh_pool.py
+# Shared paramiko connection pool for the CCS3 AP tools.
+# One authenticated SSH transport is kept per AP and reused for every SFTP
+# transfer and remote command a tool runs against that AP, so each host
+# only pays for key exchange and password auth once per run.
+#
+# sock_source, if given, is called with the host before connecting and may
+# return an already-connected socket (e.g. from an SSH port probe) to run
+# the session over instead of opening a new TCP connection.
+#
+# profile, if given, is an ssh_profiles.SSHProfile whose cipher, MAC and key
+# exchange preferences every new session negotiates with.
+
+import threading
+import paramiko
+
+SSH_PORT = 22
+SSH_USERNAME = 'root'
+CONNECT_TIMEOUT = 30
+
+
+class SSHPool:
+    """Keep one authenticated paramiko SSHClient per host."""
+
+    def __init__(self, password, username=SSH_USERNAME, port=SSH_PORT, timeout=CONNECT_TIMEOUT,
+                 sock_source=None, profile=None):
+        if not password:
+            raise ValueError("No SSH password given to the connection pool.")
+        self.password = password
+        self.username = username
+        self.port = port
+        self.timeout = timeout
+        self.sock_source = sock_source
+        self.profile = profile
+        self._clients = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def _connect(self, host, timeout, sock=None):
+        client = paramiko.SSHClient()
+        # Same behaviour as StrictHostKeyChecking=no / UserKnownHostsFile=/dev/null.
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            host,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            timeout=timeout,
+            banner_timeout=timeout,
+            auth_timeout=timeout,
+            # Password auth only: don't spend round trips offering keys or agent identities.
+            look_for_keys=False,
+            allow_agent=False,
+            sock=sock,
+            transport_factory=self.profile.transport_factory if self.profile is not None else None,
+        )
+        return client
+
+    def get(self, host, timeout=None):
+        """Return a connected client for the host, logging in on first use."""
+        with self._host_lock(host):
+            client = self._clients.get(host)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+                client.close()
+            timeout = timeout or self.timeout
+            sock = self.sock_source(host) if self.sock_source else None
+            try:
+                client = self._connect(host, timeout, sock)
+            except (paramiko.SSHException, EOFError, OSError):
+                if sock is None:
+                    raise
+                # The probe socket went stale while waiting; start afresh.
+                sock.close()
+                client = self._connect(host, timeout)
+            with self._lock:
+                self._clients[host] = client
+            return client
+
+    def sftp(self, host, timeout=None):
+        """Open an SFTP session on the host's pooled transport."""
+        return self.get(host, timeout).open_sftp()
+
+    def close(self, host):
+        """Close and forget the pooled connection to the host."""
+        with self._lock:
+            client = self._clients.pop(host, None)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        """Close every pooled connection."""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close_all()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# ssh_profiles.py
+# Named SSH algorithm profiles for the pooled connections.
+# The client's order decides which cipher, MAC and key exchange an SSH
+# session negotiates, and on the AP6's PowerPC CPU, with no crypto
+# instructions, that choice caps transfer throughput. A profile puts its
+# algorithms first and keeps paramiko's others after them as fallbacks, so
+# an AP that lacks them still connects.
+#
+# Measure mode connects to a sample AP once per cipher (then once per MAC
+# with the fastest cipher), streams data through 'cat > /dev/null' and
+# records the winners for the AP's hardware type ('uname -m', e.g. ppc). The
+# hardware type can then be used as a profile name:
+#
+#   python ssh_profiles.py 10.1.2.3           # measure, record as e.g. 'ppc'
+#   python ap_copy_fw_ccs3.py aps.csv fw.dist up.sh --ssh-profile ppc
+#   python ssh_profiles.py                    # list the profiles
+
+import json
+import os
+import socket
+import sys
+import time
+from collections import namedtuple
+
+import paramiko
+
+from remote_cmd import run_command
+from ssh_pool import SSHPool
+
+
+class SSHProfile(namedtuple('SSHProfile', ['name', 'ciphers', 'macs', 'kex', 'strict'],
+                            defaults=((), (), (), False))):
+    """Preferred ciphers, MACs and key exchanges; with strict set, sessions offer nothing else."""
+
+    __slots__ = ()
+
+    def apply(self, transport):
+        """Set the transport's algorithm preferences, before it negotiates."""
+        options = transport.get_security_options()
+        for field, preferred in (('ciphers', self.ciphers), ('digests', self.macs), ('kex', self.kex)):
+            if not preferred:
+                continue
+            available = getattr(options, field)
+            chosen = tuple(dict.fromkeys(name for name in preferred if name in available))
+            if not self.strict:
+                chosen += tuple(name for name in available if name not in chosen)
+            setattr(options, field, chosen)
+
+    def transport_factory(self, *args, **kwargs):
+        """Create a paramiko Transport with the profile applied (SSHClient.connect's transport_factory)."""
+        transport = paramiko.Transport(*args, **kwargs)
+        self.apply(transport)
+        return transport
+
+
+# Software AES-CTR with HMAC-SHA1 is the cheapest pair for a CPU without
+# crypto extensions; curve25519 is the cheapest key exchange.
+FAST_TRANSFER = SSHProfile(
+    'fast-transfer',
+    ciphers=('aes128-ctr', 'aes128-gcm@openssh.com'),
+    macs=('hmac-sha1', 'hmac-sha2-256'),
+    kex=('curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256', 'diffie-hellman-group14-sha256'),
+)
+PROFILES = {
+    'default': SSHProfile('default'),
+    'fast-transfer': FAST_TRANSFER,
+}
+DEFAULT_PROFILE = 'default'
+
+MEASURE_BYTES = 8 * 1024 * 1024
+MEASURE_CHUNK = 32768
+# AEAD ciphers authenticate without a separate MAC.
+AEAD_SUFFIX = '-gcm@openssh.com'
+
+
+def default_profiles_path():
+    """Return the per-user file of measured profiles."""
+    base = os.getenv('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(base, 'ap_ccs3', 'ssh_profiles.json')
+
+
+def _read_measured(path):
+    try:
+        with open(path) as file:
+            entries = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def load_profile(name, path=None):
+    """Return the built-in or measured profile called name.
+
+    A measured profile puts the recorded winners ahead of the fast-transfer
+    algorithms. Raises KeyError for an unknown name.
+    """
+    if name in PROFILES:
+        return PROFILES[name]
+    entry = _read_measured(path or default_profiles_path()).get(name)
+    if entry is None:
+        raise KeyError(name)
+    return SSHProfile(name, tuple(entry['ciphers']) + FAST_TRANSFER.ciphers,
+                      tuple(entry['macs']) + FAST_TRANSFER.macs, FAST_TRANSFER.kex)
+
+
+def _throughput(password, host, profile, nbytes):
+    """Return the Mbit/s one session using the profile pushes through to the AP."""
+    with SSHPool(password, profile=profile) as pool:
+        client = pool.get(host)
+        transport = client.get_transport()
+        block = os.urandom(MEASURE_CHUNK)
+        channel = transport.open_session()
+        try:
+            started = time.monotonic()
+            channel.exec_command('cat > /dev/null')
+            for _ in range(nbytes // MEASURE_CHUNK):
+                channel.sendall(block)
+            channel.shutdown_write()
+            channel.recv_exit_status()
+            seconds = time.monotonic() - started
+        finally:
+            channel.close()
+        return nbytes * 8 / 1e6 / seconds
+
+
+def _offered(field):
+    """Return the algorithms of one kind ('ciphers' or 'digests') paramiko offers, in its order."""
+    with socket.socket() as sock:
+        return getattr(paramiko.Transport(sock).get_security_options(), field)
+
+
+def _attempt(password, host, profile, nbytes, label):
+    """Measure one profile; return its Mbit/s, or None if the AP rejected it or the login failed."""
+    try:
+        rate = _throughput(password, host, profile, nbytes)
+    except paramiko.AuthenticationException as e:
+        # Negotiation got as far as the login, so the algorithms are fine.
+        print(f"{label}: accepted by {host}, but the login failed ({e})")
+        return None
+    except (paramiko.SSHException, EOFError):
+        print(f"{label}: not offered by {host}")
+        return None
+    except OSError as e:
+        print(f"{label}: could not connect to {host} ({e})")
+        return None
+    print(f"{label}: {rate:.1f} Mbit/s")
+    return rate
+
+
+def hardware_type(password, host):
+    """Return the AP's hardware type, as reported by 'uname -m'."""
+    with SSHPool(password) as pool:
+        return run_command(pool.get(host), 'uname -m').stdout.strip() or 'unknown'
+
+
+def measure(password, host, nbytes=MEASURE_BYTES):
+    """Benchmark every cipher, then every MAC, the AP accepts; return {'ciphers', 'macs', 'mbps'}.
+
+    Winners come first in 'ciphers' and 'macs'; 'mbps' maps each accepted
+    cipher or cipher/MAC pair to its measured throughput.
+    """
+    mbps = {}
+    ciphers = {}
+    for cipher in _offered('ciphers'):
+        rate = _attempt(password, host, SSHProfile(cipher, ciphers=(cipher,), strict=True), nbytes, cipher)
+        if rate is not None:
+            ciphers[cipher] = mbps[cipher] = rate
+    if not ciphers:
+        raise paramiko.SSHException(f"no cipher could be measured on {host}")
+    best_cipher = max(ciphers, key=ciphers.get)
+
+    macs = {}
+    if not best_cipher.endswith(AEAD_SUFFIX):
+        for mac in _offered('digests'):
+            profile = SSHProfile(mac, ciphers=(best_cipher,), macs=(mac,), strict=True)
+            rate = _attempt(password, host, profile, nbytes, f"{best_cipher} + {mac}")
+            if rate is not None:
+                macs[mac] = mbps[f"{best_cipher}+{mac}"] = rate
+    return {
+        'ciphers': [best_cipher],
+        'macs': [max(macs, key=macs.get)] if macs else [],
+        'mbps': {name: round(rate, 1) for name, rate in mbps.items()},
+    }
+
+
+def record(hardware, host, result, path=None):
+    """Save a measurement as the profile for the hardware type."""
+    path = path or default_profiles_path()
+    entries = _read_measured(path)
+    entries[hardware] = dict(result, host=host, measured_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(entries, file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def add_profile_args(parser):
+    """Add the SSH algorithm profile options."""
+    parser.add_argument('--ssh-profile', default=DEFAULT_PROFILE, metavar='NAME',
+                        help=f"SSH algorithm profile: {', '.join(PROFILES)}, or a hardware type measured with "
+                             f"ssh_profiles.py (default: {DEFAULT_PROFILE}).")
+    parser.add_argument('--ssh-profiles', metavar='PATH',
+                        help='Measured profiles file written by ssh_profiles.py '
+                             '(default: ~/.local/state/ap_ccs3/ssh_profiles.json).')
+
+
+def profile_from_args(args):
+    """Load the profile named by --ssh-profile, or None for paramiko's defaults."""
+    if args.ssh_profile == DEFAULT_PROFILE:
+        return None
+    try:
+        return load_profile(args.ssh_profile, args.ssh_profiles)
+    except KeyError:
+        print(f"Error: Unknown SSH profile {args.ssh_profile}; run ssh_profiles.py to list the profiles.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure SSH cipher throughput against a sample AP and record '
+                                                 'the fastest as the profile for its hardware type, or list the '
+                                                 'profiles.')
+    parser.add_argument('host', nargs='?', help='Sample AP to measure (omit to list the profiles).')
+    parser.add_argument('--size', type=float, default=MEASURE_BYTES / 1024 / 1024,
+                        help=f'MiB to send per measurement (default: {MEASURE_BYTES // 1024 // 1024}).')
+    parser.add_argument('--profiles', metavar='PATH',
+                        help='Measured profiles file (default: ~/.local/state/ap_ccs3/ssh_profiles.json).')
+    args = parser.parse_args()
+    path = args.profiles or default_profiles_path()
+
+    if not args.host:
+        for profile in PROFILES.values():
+            print(f"{profile.name}: {', '.join(profile.ciphers + profile.macs) or 'paramiko defaults'}")
+        for hardware, entry in sorted(_read_measured(path).items()):
+            print(f"{hardware}: {', '.join(entry['ciphers'] + entry['macs'])} "
+                  f"(measured on {entry['host']} at {entry['measured_at']})")
+        sys.exit(0)
+
+    password = os.getenv('SSHPASS')
+    if not password:
+        raise ValueError("No SSH password found. Please set the SSHPASS environment variable.")
+    hardware = hardware_type(password, args.host)
+    print(f"{args.host}: hardware type {hardware}")
+    result = measure(password, args.host, int(args.size * 1024 * 1024))
+    record(hardware, args.host, result, path)
+    print(f"Recorded profile '{hardware}': {', '.join(result['ciphers'] + result['macs'])}")
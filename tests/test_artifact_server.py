@@ -0,0 +1,82 @@
+# test_artifact_server.py
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+from artifact_server import ArtifactServer, parse_range
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=900-5000', (900, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=999-999', (999, 999)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', [None, '', 'items=0-10', 'bytes=0-1,5-6', 'bytes=a-b', 'bytes=-'])
+def test_unsupported_range_sends_the_whole_file(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=5000-6000', 'bytes=20-10', 'bytes=-0'])
+def test_range_outside_the_file_is_rejected(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = tmp_path / 'fw.dist'
+    path.write_bytes(bytes(range(256)) * 40)
+    server = ArtifactServer(bind='127.0.0.1')
+    server.start([str(path)])
+    yield server, path.read_bytes()
+    server.close()
+
+
+# Talk to the server directly, whatever proxy the environment sets.
+_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def get(server, name, token=None, headers=None):
+    url = f"http://127.0.0.1:{server.port}/{token or server.token}/{name}"
+    with _opener.open(urllib.request.Request(url, headers=headers or {})) as response:
+        return response.status, response.headers, response.read()
+
+
+def test_server_sends_the_file(server):
+    server, content = server
+    status, headers, body = get(server, 'fw.dist')
+    assert status == 200
+    assert body == content
+    assert headers['Accept-Ranges'] == 'bytes'
+
+
+def test_server_resumes_with_a_range_request(server):
+    server, content = server
+    status, headers, body = get(server, 'fw.dist', headers={'Range': 'bytes=4000-'})
+    assert status == 206
+    assert body == content[4000:]
+    assert headers['Content-Range'] == f"bytes 4000-{len(content) - 1}/{len(content)}"
+
+
+def test_server_rejects_a_range_past_the_end(server):
+    server, content = server
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(server, 'fw.dist', headers={'Range': f"bytes={len(content)}-"})
+    assert error.value.code == 416
+
+
+@pytest.mark.parametrize('name, token', [('fw.dist', 'wrong-token'), ('other.dist', None), ('', None)])
+def test_server_only_serves_its_artifacts_to_token_holders(server, name, token):
+    server, _ = server
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(server, name, token)
+    assert error.value.code == 404
@@ -0,0 +1,98 @@
+# test_bandwidth.py
+
+import pytest
+
+import bandwidth
+from bandwidth import BandwidthGovernor, TokenBucket, mbps_to_bytes
+
+
+class Clock:
+    """Stands in for time.monotonic and time.sleep, so the buckets run on simulated time."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bandwidth.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(bandwidth.time, 'sleep', clock.sleep)
+    return clock
+
+
+def send(bucket, clock, nbytes, chunk):
+    """Send nbytes in chunks, waiting as the bucket says; return the seconds taken."""
+    started = clock.now
+    for _ in range(nbytes // chunk):
+        clock.sleep(bucket.reserve(chunk))
+    return clock.now - started
+
+
+def test_burst_goes_out_without_waiting(clock):
+    bucket = TokenBucket(rate=1000, burst=500)
+    assert bucket.reserve(300) == 0.0
+    assert bucket.reserve(200) == 0.0
+    assert bucket.reserve(100) == pytest.approx(0.1)
+
+
+def test_tokens_refill_at_the_rate_up_to_the_burst(clock):
+    bucket = TokenBucket(rate=1000, burst=500)
+    bucket.reserve(500)
+    clock.sleep(0.2)
+    assert bucket.reserve(200) == 0.0
+    clock.sleep(10)
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(1) > 0
+
+
+def test_concurrent_reservations_queue_behind_each_other(clock):
+    bucket = TokenBucket(rate=1000, burst=100)
+    bucket.reserve(100)
+    first = bucket.reserve(100)
+    second = bucket.reserve(100)
+    assert first == pytest.approx(0.1)
+    assert second == pytest.approx(0.2)
+
+
+def test_achieved_rate_leaves_out_the_burst(clock):
+    rate = mbps_to_bytes(8)
+    bucket = TokenBucket(rate, burst=65536)
+    send(bucket, clock, 4 * 1024 * 1024, 32768)
+    assert bucket.achieved() == pytest.approx(rate, rel=0.01)
+
+
+def test_achieved_is_none_when_everything_fit_in_the_burst(clock):
+    bucket = TokenBucket(rate=1000, burst=500)
+    bucket.reserve(500)
+    assert bucket.achieved() is None
+
+
+def test_governor_limits_each_subnet_and_the_total(clock):
+    governor = BandwidthGovernor(global_mbps=16, subnet_mbps=8)
+    chunk = 32768
+    started = clock.now
+    for _ in range(128):
+        governor.throttle('10.0.1.5', chunk)
+    one_site = clock.now - started
+    assert one_site == pytest.approx((128 * chunk - 65536) / mbps_to_bytes(8), rel=0.01)
+
+    governor = BandwidthGovernor(global_mbps=16, subnet_mbps=8)
+    started = clock.now
+    for _ in range(128):
+        governor.throttle('10.0.1.5', chunk)
+        governor.throttle('10.0.2.5', chunk)
+    # Two sites at 8 Mbit/s each fit in 16 Mbit/s together.
+    assert clock.now - started == pytest.approx(one_site, rel=0.05)
+    assert governor.subnet('10.0.1.5') != governor.subnet('10.0.2.5')
+
+
+def test_governor_without_limits_is_disabled():
+    assert not BandwidthGovernor().enabled
+    assert BandwidthGovernor(subnet_mbps=5).enabled
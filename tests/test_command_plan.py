@@ -0,0 +1,93 @@
+# test_command_plan.py
+
+import subprocess
+
+import pytest
+
+from command_plan import CommandPlan, PlanResult, _parse_records
+
+MARKER = '@@plan-test'
+
+
+def run_locally(plan):
+    """Run the rendered plan through the local sh, the way the AP runs it."""
+    output = subprocess.run(['sh', '-s'], input=plan.render(MARKER).encode('utf-8'), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, check=False).stdout
+    return PlanResult(plan.steps, _parse_records(output, MARKER))
+
+
+def test_parse_records_splits_output_by_length():
+    data = (b'noise\n'
+            b'@@plan-test first 0 10.00 10.25 6 0\nline\n\n'
+            b'@@plan-test second 2 10.25 10.50 0 5\noops\n')
+    records = _parse_records(data, MARKER)
+    assert records['first'].exit_status == 0
+    assert records['first'].duration == 0.25
+    assert records['first'].stdout == 'line\n\n'
+    assert records['second'].exit_status == 2
+    assert records['second'].stderr == 'oops\n'
+
+
+def test_parse_records_output_may_contain_the_marker():
+    output = b'@@plan-test fake 0 1 1 0 0\n'
+    data = b'@@plan-test first 0 1 1 %d 0\n' % len(output) + output
+    records = _parse_records(data, MARKER)
+    assert list(records) == ['first']
+    assert records['first'].stdout == output.decode()
+
+
+def test_parse_records_stops_at_a_truncated_header():
+    data = b'@@plan-test first 0 1 1 0 0\n@@plan-test second 0 1'
+    assert list(_parse_records(data, MARKER)) == ['first']
+
+
+def test_plan_runs_every_step_and_reports_output():
+    plan = CommandPlan().add('hello', 'echo hello').add('err', 'echo bad >&2; exit 3', stop_on_error=False)
+    plan.add('after', 'echo after')
+    result = run_locally(plan)
+    assert result['hello'].stdout == 'hello\n'
+    assert result['err'].exit_status == 3
+    assert result['err'].stderr == 'bad\n'
+    assert result['after'].exit_status == 0
+    assert result.failed.name == 'err'
+    assert not result.ok
+
+
+def test_failing_step_stops_the_plan():
+    plan = CommandPlan().add('fail', 'false').add('skipped', 'echo never')
+    result = run_locally(plan)
+    assert result['fail'].exit_status == 1
+    assert result['skipped'].exit_status is None
+    assert result.failed.name == 'fail'
+
+
+def test_set_e_ends_the_step_at_the_first_failure():
+    plan = CommandPlan().add('strict', 'set -e; false; echo not reached', stop_on_error=False)
+    result = run_locally(plan)
+    assert result['strict'].exit_status == 1
+    assert result['strict'].stdout == ''
+
+
+def test_exit_in_a_step_does_not_end_the_plan():
+    plan = CommandPlan().add('leave', 'exit 0').add('next', 'echo still here')
+    result = run_locally(plan)
+    assert result.ok
+    assert result['next'].stdout == 'still here\n'
+
+
+def test_commands_are_quoted():
+    plan = CommandPlan(cwd='/').add('quotes', "printf '%s\\n' \"it's\" $PWD")
+    result = run_locally(plan)
+    assert result['quotes'].stdout == "it's\n/\n"
+
+
+@pytest.mark.parametrize('name', ['has space', 'semi;colon', ''])
+def test_add_rejects_unsafe_step_names(name):
+    with pytest.raises(ValueError):
+        CommandPlan().add(name, 'true')
+
+
+def test_add_rejects_duplicate_step_names():
+    plan = CommandPlan().add('once', 'true')
+    with pytest.raises(ValueError):
+        plan.add('once', 'true')
@@ -0,0 +1,62 @@
+# test_fanout.py
+
+import ipaddress
+
+from fanout import plan_fanout
+
+
+def depth_of(host, parents):
+    depth = 0
+    while parents[host] is not None:
+        host = parents[host]
+        depth += 1
+    return depth
+
+
+def test_every_host_is_planned_once():
+    hosts = [f"10.0.{site}.{n}" for site in range(3) for n in range(1, 60)]
+    parents = plan_fanout(hosts)
+    assert sorted(parents) == sorted(hosts)
+
+
+def test_first_host_of_each_subnet_is_its_seed():
+    hosts = ['10.0.1.9', '10.0.2.4', '10.0.1.3', '10.0.2.1']
+    parents = plan_fanout(hosts)
+    assert parents['10.0.1.9'] is None
+    assert parents['10.0.2.4'] is None
+    assert parents['10.0.1.3'] == '10.0.1.9'
+    assert parents['10.0.2.1'] == '10.0.2.4'
+
+
+def test_parents_stay_in_the_subnet_and_tree_is_limited():
+    hosts = [f"10.0.{site}.{n}" for site in range(2) for n in range(1, 255)]
+    parents = plan_fanout(hosts, prefix=24, depth=2, width=3)
+    children = {}
+    for host, parent in parents.items():
+        if parent is not None:
+            assert ipaddress.ip_network(f"{host}/24", strict=False) == ipaddress.ip_network(f"{parent}/24",
+                                                                                           strict=False)
+            children.setdefault(parent, []).append(host)
+            assert depth_of(host, parents) <= 2
+    assert max(len(hosts) for hosts in children.values()) == 3
+    # A seed, 3 children and 9 grandchildren per subnet; the rest go direct.
+    assert sum(parent is not None for parent in parents.values()) == 2 * 12
+
+
+def test_tree_is_filled_breadth_first():
+    hosts = [f"10.0.0.{n}" for n in range(1, 8)]
+    parents = plan_fanout(hosts, depth=3, width=2)
+    assert [parents[host] for host in hosts] == [None, '10.0.0.1', '10.0.0.1', '10.0.0.2', '10.0.0.2',
+                                                 '10.0.0.3', '10.0.0.3']
+
+
+def test_prefix_sets_the_subnet_size():
+    hosts = ['10.0.0.1', '10.0.1.1']
+    assert plan_fanout(hosts, prefix=24)['10.0.1.1'] is None
+    assert plan_fanout(hosts, prefix=16)['10.0.1.1'] == '10.0.0.1'
+
+
+def test_names_that_are_not_addresses_are_uploaded_directly():
+    parents = plan_fanout(['ap-01.example', '10.0.0.1', '10.0.0.2'])
+    assert parents['ap-01.example'] is None
+    assert parents['10.0.0.2'] == '10.0.0.1'
@@ -0,0 +1,96 @@
+# test_inventory.py
+
+import argparse
+import ipaddress
+
+import pytest
+
+from inventory import HostSelection, _shard, read_hosts_from_csv, shard_of
+
+
+def write_csv(path, hosts, reasons=None):
+    lines = ['SNMP_Host,reason' if reasons is not None else 'SNMP_Host']
+    for index, host in enumerate(hosts):
+        lines.append(f"{host},{reasons[index]}" if reasons is not None else host)
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_hosts_are_validated_and_deduplicated(tmp_path):
+    first = write_csv(tmp_path / 'first.csv', ['10.0.0.1', 'not-an-ip', '10.0.0.2', '10.0.0.1', ''])
+    second = write_csv(tmp_path / 'second.csv', ['10.0.0.2', '10.0.0.3'])
+    assert list(read_hosts_from_csv([first, second])) == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+
+def test_empty_selection_keeps_every_host(tmp_path):
+    inventory = write_csv(tmp_path / 'inventory.csv', ['10.0.0.1', '10.0.0.2'])
+    assert list(read_hosts_from_csv(inventory, HostSelection())) == ['10.0.0.1', '10.0.0.2']
+
+
+def test_exclude_and_intersect(tmp_path):
+    inventory = write_csv(tmp_path / 'inventory.csv', ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'])
+    failed = write_csv(tmp_path / 'failed.csv', ['10.0.0.2'])
+    wanted = write_csv(tmp_path / 'wanted.csv', ['10.0.0.2', '10.0.0.3', '10.0.0.4'])
+    site = write_csv(tmp_path / 'site.csv', ['10.0.0.3', '10.0.0.4', '10.0.0.9'])
+    selection = HostSelection(exclude_files=[failed], intersect_files=[wanted, site])
+    assert list(read_hosts_from_csv(inventory, selection)) == ['10.0.0.3', '10.0.0.4']
+
+
+def test_cidr_and_octet_filters(tmp_path):
+    inventory = write_csv(tmp_path / 'inventory.csv',
+                          ['10.90.4.240', '10.90.4.7', '10.90.5.240', '10.91.0.241', '2001:db8::1'])
+    selection = HostSelection(cidrs=['10.90.4.0/24', '10.91.0.0/16'], octets={240, 241})
+    assert list(read_hosts_from_csv(inventory, selection)) == ['10.90.4.240', '10.91.0.241']
+    selection = HostSelection(cidrs=['2001:db8::/32'])
+    assert list(read_hosts_from_csv(inventory, selection)) == ['2001:db8::1']
+
+
+def test_limit_counts_selected_hosts_only(tmp_path):
+    inventory = write_csv(tmp_path / 'inventory.csv', ['10.0.0.1', '10.0.1.1', '10.0.0.2', '10.0.0.3'])
+    selection = HostSelection(cidrs=['10.0.0.0/24'], limit=2)
+    assert list(read_hosts_from_csv(inventory, selection)) == ['10.0.0.1', '10.0.0.2']
+
+
+def test_retry_keeps_hosts_that_failed_for_the_given_reasons(tmp_path):
+    inventory = write_csv(tmp_path / 'inventory.csv', ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+    results = write_csv(tmp_path / 'results.csv', ['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+                        ['', 'timeout', 'auth_failed'])
+    assert list(read_hosts_from_csv(inventory, HostSelection(retry_files=[results]))) == ['10.0.0.2', '10.0.0.3']
+    selection = HostSelection(retry_files=[results], reasons=['timeout'])
+    assert list(read_hosts_from_csv(inventory, selection)) == ['10.0.0.2']
+
+
+def test_accepts_matches_addresses_not_strings(tmp_path):
+    listed = write_csv(tmp_path / 'listed.csv', ['2001:db8::1'])
+    selection = HostSelection(exclude_files=[listed])
+    assert not selection.accepts(ipaddress.ip_address('2001:0db8:0:0::1'))
+    assert selection.accepts(ipaddress.ip_address('2001:db8::2'))
+
+
+def test_shards_are_disjoint_and_cover_the_inventory():
+    addresses = [ipaddress.ip_address(f"10.{n // 256 % 256}.{n % 256}.{n % 7 + 1}") for n in range(2000)]
+    for count in (1, 3, 8):
+        shards = [{address for address in addresses if shard_of(address, count) == index}
+                  for index in range(1, count + 1)]
+        assert sum(len(shard) for shard in shards) == len(addresses)
+        assert set().union(*shards) == set(addresses)
+        assert all(shards), 'every shard gets some hosts'
+
+
+def test_shard_of_is_stable():
+    # Every controller has to agree on the split, so it must not depend on the
+    # process (hash() is salted per run) or the machine.
+    assert [shard_of(ipaddress.ip_address(f"10.0.0.{n}"), 3) for n in range(1, 9)] == [2, 3, 3, 2, 2, 2, 2, 1]
+
+
+def test_shard_selection_splits_a_csv_without_overlap(tmp_path):
+    hosts = [f"10.0.{n // 250}.{n % 250 + 1}" for n in range(600)]
+    inventory = write_csv(tmp_path / 'inventory.csv', hosts + hosts[:50])
+    shards = [list(read_hosts_from_csv(inventory, HostSelection(shard=(index, 3)))) for index in (1, 2, 3)]
+    assert sorted(sum(shards, []), key=ipaddress.ip_address) == sorted(hosts, key=ipaddress.ip_address)
+
+
+@pytest.mark.parametrize('value', ['0/3', '4/3', '1/0', '2', 'a/b'])
+def test_invalid_shards_are_rejected(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        _shard(value)
@@ -0,0 +1,89 @@
+# test_sftp_upload.py
+
+import os
+import subprocess
+
+import pytest
+
+from remote_cmd import CommandResult
+from sftp_upload import ChecksumMismatch, finish_parts, staging_paths
+
+
+class LocalClient:
+    """Runs 'remote' commands on this machine, like an ssh_mux client runs them on the AP."""
+
+    def __init__(self):
+        self.commands = []
+
+    def run_command(self, command, timeout=None, stdin=None, encoding='utf-8'):
+        self.commands.append(command)
+        result = subprocess.run(['sh', '-c', command], input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=timeout, text=encoding is not None, check=False)
+        return CommandResult(command, result.returncode, result.stdout, result.stderr)
+
+
+@pytest.fixture
+def artifacts(tmp_path):
+    local = tmp_path / 'local'
+    local.mkdir()
+    paths = []
+    for name, content in (('fw.dist', b'\x00firmware' * 1000), ('upgrade.sh', b'#!/bin/sh\n')):
+        (local / name).write_bytes(content)
+        paths.append(str(local / name))
+    destination = tmp_path / 'ap'
+    destination.mkdir()
+    return paths, str(destination)
+
+
+def stage_parts(paths, destination):
+    for path, part in staging_paths(paths, destination)[1].items():
+        with open(path, 'rb') as source, open(part, 'wb') as target:
+            target.write(source.read())
+
+
+def test_staging_paths():
+    remote_paths, part_paths = staging_paths(['/build/fw.dist'], '/tmp')
+    assert remote_paths == {'/build/fw.dist': '/tmp/fw.dist'}
+    assert part_paths == {'/build/fw.dist': '/tmp/fw.dist.part'}
+
+
+def test_verified_parts_are_renamed_into_place(artifacts):
+    paths, destination = artifacts
+    stage_parts(paths, destination)
+    finish_parts(LocalClient(), paths, destination)
+    assert sorted(os.listdir(destination)) == ['fw.dist', 'upgrade.sh']
+    for path in paths:
+        with open(path, 'rb') as local, open(os.path.join(destination, os.path.basename(path)), 'rb') as remote:
+            assert local.read() == remote.read()
+
+
+def test_bad_part_is_removed_and_nothing_is_renamed(artifacts):
+    paths, destination = artifacts
+    stage_parts(paths, destination)
+    with open(os.path.join(destination, 'upgrade.sh.part'), 'ab') as part:
+        part.write(b'corrupt')
+    with pytest.raises(ChecksumMismatch, match='after relay'):
+        finish_parts(LocalClient(), paths, destination, how='relay')
+    assert os.listdir(destination) == ['fw.dist.part']
+
+
+def test_unverified_parts_are_only_renamed(artifacts):
+    paths, destination = artifacts
+    stage_parts(paths, destination)
+    client = LocalClient()
+    finish_parts(client, paths, destination, verify=False)
+    assert len(client.commands) == 1
+    assert sorted(os.listdir(destination)) == ['fw.dist', 'upgrade.sh']
+
+
+def test_missing_part_fails_the_rename(artifacts):
+    paths, destination = artifacts
+    with pytest.raises(IOError, match='could not rename the files after fetch'):
+        finish_parts(LocalClient(), paths, destination, verify=False, how='fetch')
+
+
+def test_nothing_to_finish_runs_nothing(artifacts):
+    paths, destination = artifacts
+    client = LocalClient()
+    finish_parts(client, [], destination)
+    assert client.commands == []
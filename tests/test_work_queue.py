@@ -0,0 +1,93 @@
+# test_work_queue.py
+
+import time
+
+import pytest
+
+from work_queue import DONE, FAILED, LEASED, PENDING, WorkQueue
+
+HOSTS = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'queue.db')
+
+
+def queue(path, **kwargs):
+    """Open the queue file as one more controller process would."""
+    return WorkQueue(path, job='test', **kwargs)
+
+
+def test_fill_skips_hosts_already_queued(path):
+    first = queue(path)
+    assert first.fill(HOSTS) == 3
+    assert queue(path).fill(HOSTS + ['10.0.0.4']) == 1
+    assert first.counts() == {PENDING: 4}
+
+
+def test_jobs_are_kept_apart(path):
+    queue(path).fill(HOSTS)
+    other = WorkQueue(path, job='other')
+    assert other.fill(HOSTS[:1]) == 1
+    assert other.lease(10) == HOSTS[:1]
+
+
+def test_hosts_are_leased_once_in_order(path):
+    first, second = queue(path), queue(path)
+    first.fill(HOSTS)
+    assert first.lease(2) == HOSTS[:2]
+    assert second.lease(2) == HOSTS[2:]
+    assert second.lease(2) == []
+    assert first.counts() == {LEASED: 3}
+
+
+def test_expired_lease_goes_back_to_the_queue(path):
+    crashed, survivor = queue(path, lease_time=0.05), queue(path)
+    crashed.fill(HOSTS[:1])
+    assert crashed.lease(1) == HOSTS[:1]
+    assert survivor.lease(1) == []
+    time.sleep(0.1)
+    assert survivor.lease(1) == HOSTS[:1]
+
+
+def test_heartbeat_keeps_the_lease(path):
+    holder, other = queue(path, lease_time=0.2), queue(path)
+    holder.fill(HOSTS[:1])
+    holder.lease(1)
+    for _ in range(4):
+        time.sleep(0.1)
+        holder.heartbeat()
+        assert other.lease(1) == []
+
+
+def test_finish_marks_only_the_holders_hosts(path):
+    holder, other = queue(path), queue(path)
+    holder.fill(HOSTS[:2])
+    holder.lease(2)
+    other.finish(HOSTS[0], True)
+    assert holder.counts() == {LEASED: 2}
+    holder.finish(HOSTS[0], True)
+    holder.finish(HOSTS[1], False)
+    assert holder.counts() == {DONE: 1, FAILED: 1}
+    assert holder.unfinished() == 0
+
+
+def test_release_hands_hosts_back_without_using_an_attempt(path):
+    leaving, other = queue(path, max_attempts=1), queue(path, max_attempts=1)
+    leaving.fill(HOSTS[:1])
+    leaving.lease(1)
+    leaving.release()
+    assert leaving.counts() == {PENDING: 1}
+    assert other.lease(1) == HOSTS[:1]
+
+
+def test_hosts_stop_being_leased_after_max_attempts(path):
+    work = queue(path, lease_time=0.01, max_attempts=2)
+    work.fill(HOSTS[:1])
+    assert work.lease(1) == HOSTS[:1]
+    time.sleep(0.05)
+    assert work.lease(1) == HOSTS[:1]
+    time.sleep(0.05)
+    assert work.lease(1) == []
+    assert work.unfinished() == 0
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# work_queue.py
+# SQLite work queue shared by several controller processes running the same tool.
+# Every process fills the queue from its inventory (hosts already queued are
+# left alone), then leases a few hosts at a time, only as it has free SSH
+# slots. A lease expires unless the holder keeps renewing it (heartbeat), so
+# hosts leased by a process that crashed or was killed go back into the
+# queue on their own. A process that exits normally hands back whatever it
+# still holds. Launching more processes therefore adds throughput, and fast
+# processes pick up work that slow ones never got to.
+#
+# Each tool has its own job name (the tool name by default), so upgrade, copy
+# and check runs can share one queue file. Hosts stay done or failed once
+# finished; use a new --queue-job or queue file to run the same tool again.
+#
+# The default rollback journal is used instead of WAL so the queue file can
+# also live on a shared filesystem with working POSIX locks.
+
+import argparse
+import contextlib
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_TIME = 60
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5
+BUSY_TIMEOUT = 60
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    job TEXT NOT NULL,
+    host TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT NOT NULL DEFAULT '',
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job, host)
+)
+'''
+
+
+def default_job():
+    """Return the job name for the running tool."""
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'fleet'
+
+
+class WorkQueue:
+    """Hosts of one job, leased to controller processes with an expiry."""
+
+    def __init__(self, path, job=None, lease_time=LEASE_TIME, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.job = job or default_job()
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._db.execute(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Hold the write lock on the queue file for the duration of the block."""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def fill(self, hosts):
+        """Queue the hosts that are not queued for this job yet; return how many were added."""
+        now = time.time()
+        added = 0
+        with self._transaction() as db:
+            position = db.execute('SELECT COUNT(*) FROM queue WHERE job = ?', (self.job,)).fetchone()[0]
+            for host in hosts:
+                added += db.execute(
+                    'INSERT OR IGNORE INTO queue (job, host, position, state, updated_at) VALUES (?, ?, ?, ?, ?)',
+                    (self.job, host, position + added, PENDING, now)).rowcount
+        return added
+
+    def lease(self, count):
+        """Lease up to count hosts that are pending or whose lease has expired."""
+        if count <= 0:
+            return []
+        now = time.time()
+        with self._transaction() as db:
+            hosts = [row[0] for row in db.execute(
+                'SELECT host FROM queue WHERE job = ? AND attempts < ? '
+                'AND (state = ? OR (state = ? AND lease_until < ?)) ORDER BY position LIMIT ?',
+                (self.job, self.max_attempts, PENDING, LEASED, now, count))]
+            db.executemany(
+                'UPDATE queue SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1, '
+                'updated_at = ? WHERE job = ? AND host = ?',
+                [(LEASED, self.owner, now + self.lease_time, now, self.job, host) for host in hosts])
+        return hosts
+
+    def heartbeat(self):
+        """Extend the lease on every host this process holds."""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('UPDATE queue SET lease_until = ?, updated_at = ? WHERE job = ? AND state = ? AND owner = ?',
+                       (now + self.lease_time, now, self.job, LEASED, self.owner))
+
+    def finish(self, host, ok):
+        """Mark a host this process holds as done or failed."""
+        with self._transaction() as db:
+            db.execute('UPDATE queue SET state = ?, updated_at = ? WHERE job = ? AND host = ? AND owner = ?',
+                       (DONE if ok else FAILED, time.time(), self.job, host, self.owner))
+
+    def release(self):
+        """Hand every host this process still holds back to the queue."""
+        with self._transaction() as db:
+            db.execute('UPDATE queue SET state = ?, owner = ?, lease_until = 0, attempts = attempts - 1, '
+                       'updated_at = ? WHERE job = ? AND state = ? AND owner = ?',
+                       (PENDING, '', time.time(), self.job, LEASED, self.owner))
+
+    def unfinished(self):
+        """Return how many hosts of the job may still be leased, now or once a lease expires."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM queue WHERE job = ? AND state IN (?, ?) AND attempts < ?',
+                (self.job, PENDING, LEASED, self.max_attempts)).fetchone()[0]
+
+    def counts(self):
+        """Return {state: number of hosts} for the job."""
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT state, COUNT(*) FROM queue WHERE job = ? GROUP BY state', (self.job,)).fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def add_queue_args(parser):
+    """Add the work queue options for tools that can pull hosts from a shared queue."""
+    group = parser.add_argument_group('work queue')
+    group.add_argument('--queue', metavar='PATH',
+                       help='Pull hosts from this SQLite work queue, shared with other controller processes; '
+                            'the inventory is added to it first.')
+    group.add_argument('--queue-job', metavar='NAME',
+                       help='Job name within the queue (default: the tool name).')
+    group.add_argument('--lease', type=float, default=LEASE_TIME,
+                       help=f'Seconds a leased host stays reserved without a heartbeat (default: {LEASE_TIME}).')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the progress of a work queue job.')
+    parser.add_argument('queue', help='SQLite work queue file.')
+    parser.add_argument('--queue-job', metavar='NAME', required=True, help='Job name, e.g. ap_upgrade_ccs3.')
+    args = parser.parse_args()
+    queue = WorkQueue(args.queue, args.queue_job)
+    counts = queue.counts()
+    for state in (PENDING, LEASED, DONE, FAILED):
+        print(f"{state}: {counts.get(state, 0)}")
+    queue.close()